@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import os
+import sys
+import json
+import time
+import multiprocessing
+
+import yaml
+
+from buildings import BuildingMatrix
+from consts import BUILDING_INFO
+from profiler import PROFILER
+
+_worker_matrix = None
+_worker_solver = None
+
+
+def read_jobs(path):
+    """ 读取批量配置，产出 (配置标识, 配置 dict)
+    path 为目录时读取其中全部 yml 文件，否则按 JSON lines 读取，'-' 为标准输入。
+    每行为 {"id": ..., "config": {...}}，或直接为配置本身，此时以行号为标识。
+    无法解析或不是配置 dict 的条目产出 (配置标识, 异常)，由 solve_config 输出为该条目的错误结果，不中断批量。
+    """
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            if name.endswith(('.yml', '.yaml')):
+                with open(os.path.join(path, name)) as conf_file:
+                    try:
+                        yield name, yaml.load(conf_file, Loader=yaml.SafeLoader)
+                    except yaml.YAMLError as error:
+                        yield name, ValueError(str(error))
+        return
+    stream = sys.stdin if path == '-' else open(path)
+    try:
+        for line_number, line in enumerate(stream, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError as error:
+                yield line_number, error
+                continue
+            if isinstance(item, dict) and 'config' in item:
+                yield item.get('id', line_number), item['config']
+            else:
+                yield line_number, item
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+
+
+def _init_worker(solver, profile=False):
+    """ 每个进程只建立一次建筑矩阵，之后每份配置仅重置星级
+    profile 时在子进程中启用性能分析，数据随结果返回主进程合并
+    """
+    global _worker_matrix, _worker_solver
+    _worker_matrix = BuildingMatrix(BUILDING_INFO, numeric=float)
+    _worker_solver = solver
+    if profile:
+        PROFILER.enable()
+
+
+def solve_config(job):
+    config_id, config, online, only = job
+    calc_class, method = _worker_solver
+    try:
+        if isinstance(config, Exception):
+            raise config
+        if not isinstance(config, dict):
+            raise ValueError('config should be a mapping, got {}'.format(type(config).__name__))
+        calculater = calc_class(online, config, only, building_matrix=_worker_matrix)
+        confirmed_plan = getattr(calculater, method)()
+        result = calculater.plan_json(confirmed_plan)
+    except Exception as error:
+        result = {'error': '{}: {}'.format(type(error).__name__, error)}
+    return dict(id=config_id, **result)
+
+
+def _solve_pooled(job):
+    """ 子进程中求解，返回 (结果, 本份配置的性能分析数据或 None)
+    """
+    result = solve_config(job)
+    if not PROFILER.enabled:
+        return result, None
+    report = PROFILER.report()
+    PROFILER.enable()
+    return result, report
+
+
+def run_batch(path, solver, online=True, only=False, workers=1, output=sys.stdout):
+    """ 批量求解，每份配置输出一行 JSON 结果，结束后在 stderr 报告吞吐量
+    solver 为 (计算器类, 求解方法名)
+    """
+    start = time.perf_counter()
+    jobs = ((config_id, config, online, only) for config_id, config in read_jobs(path))
+    count = 0
+    if workers > 1:
+        with multiprocessing.Pool(workers, initializer=_init_worker, initargs=(solver, PROFILER.enabled)) as pool:
+            for result, report in pool.imap(_solve_pooled, jobs, chunksize=4):
+                if report is not None:
+                    PROFILER.merge(report)
+                count += _write(result, output)
+    else:
+        _init_worker(solver)
+        for result in map(solve_config, jobs):
+            count += _write(result, output)
+    elapsed = time.perf_counter() - start
+    print('{} configs in {:.3f}s, {:.1f} configs/sec'.format(
+        count, elapsed, count / elapsed if elapsed else 0), file=sys.stderr)
+
+
+def _write(result, output):
+    output.write(json.dumps(result, ensure_ascii=False) + '\n')
+    output.flush()
+    return 1
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import platform
+import subprocess
+import tracemalloc
+
+import yaml
+import click
+
+from buildings import BuildingMatrix
+from consts import STAR_NAMES, BufferConsts as Bc
+from engine import ExplosionEngine, SCORE_TOLERANCE
+from main import CalcByPick, CalcByBranch, CalcByMilp, CalcByExplosion
+
+CORPUS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarks', 'configs')
+# 超过此方案数量的目录不做爆破
+EXPLOSION_LIMIT = 2 * 10 ** 8
+# 逐个方案的爆破只在不超过此方案数量的目录上运行
+REFERENCE_LIMIT = 10 ** 4
+# 精确求解器，同一用例的最优收益应在 SCORE_TOLERANCE 以内一致
+EXACT_SOLVERS = ['branch', 'milp', 'explosion']
+# 一致性检查的每个小目录规模生成的随机配置数
+AGREEMENT_SEEDS = 5
+
+
+def synthetic_catalog(per_category, seed=0):
+    """ 生成与 BUILDING_INFO 结构相同的建筑目录，每类 per_category 个建筑
+    加成种类及系数取自 BufferConsts，单体绑定总是指向其他类别的建筑
+    """
+    rand = random.Random(seed)
+    prefixes = [(Bc.RES, 'R'), (Bc.COM, 'C'), (Bc.IND, 'I')]
+    names = {btype: ['{}{:03d}'.format(prefix, index) for index in range(per_category)]
+             for btype, prefix in prefixes}
+    catalog = []
+    for btype, _ in prefixes:
+        others = [name for other, _ in prefixes if other != btype for name in names[other]]
+        for name in names[btype]:
+            buffers = [(Bc.SGL, rand.choice([Bc.B100, Bc.B050]), rand.choice(others))]
+            extra = rand.random()
+            if extra < 0.3:
+                buffers.append((rand.choice([Bc.RES, Bc.COM, Bc.IND]), rand.choice([Bc.E015, Bc.E246])))
+            elif extra < 0.5:
+                buffers.append((rand.choice([Bc.ONL, Bc.OFL]), rand.choice([Bc.E246, Bc.E010])))
+            elif extra < 0.6:
+                buffers.append((Bc.ALL, Bc.E010))
+            catalog.append({
+                'name': name,
+                'btype': btype,
+                'buffers': buffers,
+                'fix': round(rand.uniform(1, 1.6), 3),
+            })
+    return catalog
+
+
+def synthetic_config(catalog, seed=0):
+    """ 为建筑目录生成随机的星级及全局加成配置，结构与 jiaguomeng.yml 一致
+    """
+    rand = random.Random(seed)
+    stars = {star_name: [] for star_name in STAR_NAMES}
+    for item in catalog:
+        stars[rand.choice(STAR_NAMES)].append(item['name'])
+
+    def effects(scale):
+        return {key: round(rand.uniform(0, scale), 1) for key in ['在线', '离线', '住宅', '商业', '工业']}
+
+    config = {star_name: ' '.join(names) for star_name, names in stars.items()}
+    config.update({
+        '政策': effects(10),
+        '照片': effects(3),
+        '城市任务': effects(1),
+        '城市任务建筑加成': {
+            item['name']: rand.choice([0, 0, 0, 1, 2]) for item in catalog
+        },
+    })
+    return config
+
+
+def load_cases(sizes):
+    """ 基准用例：固定的 yml 配置集合，以及逐步增大的合成建筑目录
+    """
+    cases = []
+    for name in sorted(os.listdir(CORPUS_DIR)):
+        if name.endswith('.yml'):
+            with open(os.path.join(CORPUS_DIR, name)) as conf_file:
+                config = yaml.load(conf_file, Loader=yaml.SafeLoader)
+            cases.append(('corpus/' + name, None, config))
+    for size in sizes:
+        catalog = synthetic_catalog(size, seed=size)
+        cases.append(('synthetic/{}'.format(size), catalog, synthetic_config(catalog, seed=size)))
+    return cases
+
+
+def agreement_cases(sizes, seeds=AGREEMENT_SEEDS):
+    """ 一致性检查用例：固定的 yml 配置集合，以及每类只有几个建筑的小目录，每种规模取 seeds 份随机配置
+    """
+    cases = load_cases([])
+    for size in sizes:
+        for seed in range(seeds):
+            catalog = synthetic_catalog(size, seed=seed)
+            cases.append(('agreement/{}-{}'.format(size, seed), catalog, synthetic_config(catalog, seed=seed)))
+    return cases
+
+
+def prepare(calc_class, catalog, config):
+    matrix = BuildingMatrix(catalog, numeric=float) if catalog else None
+    return calc_class(True, config, False, building_matrix=matrix)
+
+
+def count_calls(obj, name):
+    counter = [0]
+    original = getattr(obj, name)
+
+    def wrapper(*args, **kwargs):
+        counter[0] += 1
+        return original(*args, **kwargs)
+
+    setattr(obj, name, wrapper)
+    return counter
+
+
+def bench_pick(calculater, refine=None, beam_width=1, beam_depth=3):
+    counter = count_calls(calculater, 'count_total_income')
+    confirmed_plan = calculater.solve(refine=refine, beam_width=beam_width, beam_depth=beam_depth)
+    return confirmed_plan['total_income'], counter[0]
+
+
+def bench_branch(calculater):
+    confirmed_plan = calculater.solve_branch()
+    return confirmed_plan['total_income'], confirmed_plan['report']['nodes']
+
+
+def bench_milp(calculater):
+    confirmed_plan = calculater.solve_milp()
+    return confirmed_plan['total_income'], confirmed_plan['report']['nodes']
+
+
+def bench_explosion(calculater):
+    engine = ExplosionEngine(calculater.building_matrix, online=calculater.online_mod)
+    if engine.size > EXPLOSION_LIMIT:
+        return None
+    (score, plan), = engine.best(top=1)
+    return float(score), engine.size
+
+
+def bench_reference(calculater):
+    _m = calculater.building_matrix
+    size = math.prod(math.comb(len(_m.indexes[btype]), 3) for btype in [Bc.RES, Bc.COM, Bc.IND])
+    if size > REFERENCE_LIMIT:
+        return None
+    (score, _), = calculater.explosion(top=1)
+    return float(score), size
+
+
+SOLVERS = [
+    # (名称, 计算器类, 求解函数), 评估数分别为 count_total_income 调用数、搜索节点数、HiGHS 节点数、方案数
+    ('pick', CalcByPick, bench_pick),
+    ('pick-hill', CalcByPick, lambda calculater: bench_pick(calculater, refine='hill')),
+    ('pick-block', CalcByPick, lambda calculater: bench_pick(calculater, refine='block')),
+    ('pick-beam4x4', CalcByPick, lambda calculater: bench_pick(calculater, beam_width=4, beam_depth=4)),
+    ('pick-beam8x5', CalcByPick, lambda calculater: bench_pick(calculater, beam_width=8, beam_depth=5)),
+    ('branch', CalcByBranch, bench_branch),
+    ('milp', CalcByMilp, bench_milp),
+    ('explosion', CalcByPick, bench_explosion),
+]
+# 逐个方案的爆破，只在一致性检查中作为参照
+REFERENCE_SOLVERS = [
+    ('explosion-plan', CalcByExplosion, bench_reference),
+]
+
+
+def run_case(calc_class, solve, catalog, config, repeat):
+    """ 多次运行取最短耗时，峰值内存另跑一次以 tracemalloc 统计，避免追踪开销计入耗时
+    """
+
+    best_time, result = None, None
+    for _ in range(repeat):
+        calculater = prepare(calc_class, catalog, config)
+        start = time.perf_counter()
+        result = solve(calculater)
+        elapsed = time.perf_counter() - start
+        if result is None:
+            return None
+        best_time = elapsed if best_time is None else min(best_time, elapsed)
+    calculater = prepare(calc_class, catalog, config)
+    tracemalloc.start()
+    solve(calculater)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    score, evaluations = result
+    return {
+        'wall_time': best_time,
+        'evaluations': evaluations,
+        'evaluations_per_sec': evaluations / best_time if best_time else None,
+        'peak_memory': peak,
+        'score': float(score),
+    }
+
+
+def check_agreement(cases):
+    """ 各精确求解器逐个用例求解一次，收益与最高者的相对差超过 SCORE_TOLERANCE 即视为不一致
+    """
+    solvers = [(name, calc_class, solve) for name, calc_class, solve in SOLVERS if name in EXACT_SOLVERS]
+    solvers.extend(REFERENCE_SOLVERS)
+    mismatches = []
+    for case, catalog, config in cases:
+        scores = {}
+        for name, calc_class, solve in solvers:
+            result = solve(prepare(calc_class, catalog, config))
+            if result is not None:
+                scores[name] = float(result[0])
+        reference = max(scores.values())
+        for name, score in sorted(scores.items()):
+            if reference - score > abs(reference) * SCORE_TOLERANCE:
+                mismatches.append('{case} {solver}: {score:.6f} < {reference:.6f}'.format(
+                    case=case, solver=name, score=score, reference=reference))
+    return mismatches
+
+
+def import_time(module='main', repeat=5):
+    """ 在新进程中以 python -X importtime 导入模块，多次取最短的累计耗时
+    返回总耗时及自身耗时最多的几个模块，单位为微秒
+    """
+    best = None
+    for _ in range(repeat):
+        output = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.PIPE, universal_newlines=True, check=True,
+        ).stderr
+        modules = []
+        for line in output.splitlines():
+            if not line.startswith('import time:') or 'cumulative' in line:
+                continue
+            self_us, cumulative_us, name = line[len('import time:'):].split('|')
+            modules.append((name.strip(), int(self_us), int(cumulative_us)))
+        total = next(cumulative for name, _, cumulative in reversed(modules) if name == module)
+        if best is None or total < best['total']:
+            slowest = sorted(modules, key=lambda x: x[1], reverse=True)[:5]
+            best = {
+                'module': module,
+                'total': total,
+                'slowest': [{'name': name, 'self': self_us} for name, self_us, _ in slowest],
+            }
+    return best
+
+
+def compare(report, baseline, tolerance):
+    """ 与基准报告比较，耗时或峰值内存超过基准 (1 + tolerance) 倍即视为退化
+    """
+    saved = {(item['solver'], item['case']): item for item in baseline['results']}
+    regressions = []
+    for item in report['results']:
+        base = saved.get((item['solver'], item['case']))
+        if base is None:
+            continue
+        for metric in ['wall_time', 'peak_memory']:
+            if item[metric] > base[metric] * (1 + tolerance):
+                regressions.append('{solver} {case} {metric}: {old:.6g} -> {new:.6g}'.format(
+                    solver=item['solver'], case=item['case'], metric=metric,
+                    old=base[metric], new=item[metric]))
+    base_import = baseline.get('import_time')
+    if base_import and report['import_time']['total'] > base_import['total'] * (1 + tolerance):
+        regressions.append('import {module}: {old}us -> {new}us'.format(
+            module=base_import['module'], old=base_import['total'], new=report['import_time']['total']))
+    return regressions
+
+
+@click.command()
+@click.option('-s', '--sizes', default='10,15,20,30', help='Synthetic buildings per category, comma separated.')
+@click.option('-r', '--repeat', default=3, type=click.IntRange(min=1), help='Runs per case, fastest is kept.')
+@click.option('-o', '--output', default='bench_report.json', help='Report file path.')
+@click.option('-b', '--baseline', default=None, help='Baseline report to compare against.')
+@click.option('-t', '--tolerance', default=0.25, help='Allowed slowdown ratio before a regression is reported.')
+@click.option('--solvers', default=','.join(name for name, _, _ in SOLVERS), help='Solvers to run, comma separated.')
+@click.option('--import-budget', default=None, type=float, help='Maximum milliseconds to import main.')
+@click.option('--agreement-sizes', default='3,4,5,6',
+              help='Small synthetic catalogs on which the exact solvers must agree, comma separated.')
+def main(sizes, repeat, output, baseline, tolerance, solvers, import_budget, agreement_sizes):
+    selected = solvers.split(',')
+    report = {
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'import_time': import_time('main'),
+        'results': [],
+    }
+    print('import main: {:.1f}ms ({})'.format(
+        report['import_time']['total'] / 1000,
+        ', '.join('{name} {self}us'.format(**item) for item in report['import_time']['slowest'])))
+    for case, catalog, config in load_cases([int(size) for size in sizes.split(',') if size]):
+        for name, calc_class, solve in SOLVERS:
+            if name not in selected:
+                continue
+            result = run_case(calc_class, solve, catalog, config, repeat)
+            if result is None:
+                print('{:<12} {:<26} skipped'.format(name, case))
+                continue
+            result.update(solver=name, case=case)
+            report['results'].append(result)
+            print('{:<12} {:<26} {:>9.4f}s {:>12.0f}/s {:>8.1f}KB  {:.2f}'.format(
+                name, case, result['wall_time'], result['evaluations_per_sec'],
+                result['peak_memory'] / 1024, result['score']))
+    with open(output, 'w') as report_file:
+        json.dump(report, report_file, indent=2, ensure_ascii=False)
+    regressions = []
+    if import_budget is not None and report['import_time']['total'] > import_budget * 1000:
+        regressions.append('import main: {:.1f}ms over budget {:.1f}ms'.format(
+            report['import_time']['total'] / 1000, import_budget))
+    if baseline:
+        with open(baseline) as baseline_file:
+            regressions.extend(compare(report, json.load(baseline_file), tolerance))
+    for line in regressions:
+        print('Regression:', line)
+    mismatches = check_agreement(agreement_cases([int(size) for size in agreement_sizes.split(',') if size]))
+    for line in mismatches:
+        print('Mismatch:', line)
+    if regressions or mismatches:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
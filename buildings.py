@@ -2,29 +2,38 @@
 # encoding: utf-8
 # author: 04
 
-import copy
 from decimal import Decimal as D  # noqa
+from collections import namedtuple
+
 from consts import BuildingConsts, BufferConsts as Bc
 from errors import MatrixFull, MatrixCategoryFull
+from profiler import PROFILER
 
 
 class Building(object):
     """Every Building in JiaGuoMeng
+    随配置变化的数值 (星级、等级、自身收益、全局加成) 汇总于 BuildingMatrix.table()，评分只读取该快照
     """
+    __slots__ = (
+        'name', 'building_type', 'buffer_list', 'numeric', 'base_fix', 'bind_to', 'buffed_by', 'bind_order',
+        'star', 'level', 'self_effect', 'global_coefficient', 'index', 'matrix',
+    )
 
-    def __init__(self, name, btype, buffers, fix=1):
+    def __init__(self, name, btype, buffers, fix=1, numeric=D):
         self.name = name
         self.building_type = btype
         self.buffer_list = self.own_buffer(buffers)
-        self.base_fix = D(fix)
+        self.numeric = numeric
+        self.base_fix = numeric(fix)
         self.bind_to = []
         self.buffed_by = []
-        self._bind_effect = None
+        self.bind_order = []
         self.star = None
-        self.result = None
-
-    def __lt__(self, other_bd):
-        return self.result < other_bd.result
+        self.level = 1
+        self.self_effect = numeric(0)
+        self.global_coefficient = numeric(1)
+        self.index = None
+        self.matrix = None
 
     def own_buffer(self, buffers):
         for buf in buffers:
@@ -33,9 +42,44 @@ class Building(object):
 
     def set_star(self, star):
         self.star = star
-        self.self_effect = BuildingConsts.STAR_INCOME[star] * self.base_fix
+        self.self_effect = self.level_income()
         for buf in self.buffer_list:
-            buf.set_star(star)
+            buf.set_star(star, self.numeric)
+        if self.matrix is not None:
+            self.matrix.invalidate()
+
+    def set_level(self, level):
+        """ 等级只影响自身收益，不改变加成系数，故只需重建数值快照
+        """
+        if not 1 <= level <= BuildingConsts.MAX_LEVEL:
+            raise ValueError('Level %s of %s is out of range.' % (level, self.name))
+        self.level = level
+        self.self_effect = self.level_income()
+        if self.matrix is not None:
+            self.matrix.invalidate_table()
+
+    def level_income(self, level=None):
+        """ 星级收益 * 基础修正 * 等级收益倍数，倍数查所属建筑矩阵的等级曲线
+        """
+        if self.star is None:
+            return self.numeric(0)
+        level = self.level if level is None else level
+        curves = BuildingConsts.LEVEL_CURVES if self.matrix is None else self.matrix.curves
+        return (BuildingConsts.STAR_INCOME[self.star] * self.base_fix *
+                self.numeric(curves.income[level]))
+
+    def reset_star(self):
+        self.star = None
+        self.level = 1
+        self.self_effect = self.numeric(0)
+        self.global_coefficient = self.numeric(1)
+        for buf in self.buffer_list:
+            buf.coefficient = self.numeric(0)
+
+    def set_global_coefficient(self, coefficient):
+        self.global_coefficient = coefficient
+        if self.matrix is not None:
+            self.matrix.invalidate_table()
 
     def lookup_bind(self, matrix):
         """绑定建筑关联
@@ -66,6 +110,7 @@ class Building(object):
 
 
 class Buffer(object):
+    __slots__ = ('buffer_type', 'bind_name', 'coefficient')
 
     def __init__(self, buffer_type, coefficient, bind_name=None):
         if buffer_type not in Bc.BUFFER_TYPE_OPTIONS:
@@ -80,6 +125,7 @@ class Buffer(object):
         """ 检测此收益加成是否适用于此建筑
         注：火车收益不列入此计算
         """
+        PROFILER.count('fit_income')
         btype = self.buffer_type
         if btype in [Bc.IND, Bc.COM, Bc.RES]:
             return btype == building.building_type
@@ -100,6 +146,7 @@ class Buffer(object):
 
 
 class GlobalBuffer(Buffer):
+    __slots__ = ('global_type',)
 
     def __init__(self, global_type, buffer_type, coefficient, bind_name=None):
         self.global_type = global_type
@@ -112,19 +159,19 @@ class GlobalBuffer(Buffer):
 
 
 class BuildingBuffer(Buffer):
+    __slots__ = ('coefficient_type', '_star', 'buffer_from')
 
     def __init__(self, buffer_type, coefficient_type, bind_name=None):
         if coefficient_type not in Bc.COEFFICIENT_OPTIONS:
-            __import__('ipdb').set_trace()
             raise ValueError('Coeffecient_type %s is not allowed.' % coefficient_type)
         self.coefficient_type = coefficient_type
         self._star = None
         self.buffer_from = None
         super().__init__(buffer_type, None, bind_name)
 
-    def set_star(self, star):
+    def set_star(self, star, numeric=D):
         self._star = star
-        self.coefficient = self.coefficient_type[self._star - 1]
+        self.coefficient = numeric(self.coefficient_type[self._star - 1])
 
     def __unicode__(self):
         return '<Buffer:{}-{}|{}{}>'.format(
@@ -135,21 +182,139 @@ class BuildingBuffer(Buffer):
         )
 
 
+class Plan(object):
+    """ 建筑方案，以建筑序号为位的整数掩码表示
+    成员判断、合并、分类计数及哈希都是位运算，方案不可变，修改总是返回新方案
+    """
+
+    __slots__ = ('matrix', 'mask')
+
+    CATEGORY_SIZE = 3
+    PLAN_SIZE = 9
+
+    def __init__(self, matrix, mask=0):
+        self.matrix = matrix
+        self.mask = mask
+
+    @classmethod
+    def from_buildings(cls, matrix, buildings):
+        mask = 0
+        for bd in buildings:
+            mask |= 1 << bd.index
+        return cls(matrix, mask)
+
+    def __contains__(self, building):
+        return bool(self.mask >> building.index & 1)
+
+    def __or__(self, other):
+        return Plan(self.matrix, self.mask | other.mask)
+
+    def __len__(self):
+        return self.mask.bit_count()
+
+    def __iter__(self):
+        mask = self.mask
+        while mask:
+            low = mask & -mask
+            yield self.matrix.ordered[low.bit_length() - 1]
+            mask ^= low
+
+    def __eq__(self, other):
+        return isinstance(other, Plan) and self.mask == other.mask
+
+    def __hash__(self):
+        return hash(self.mask)
+
+    def count(self, btype):
+        return (self.mask & self.matrix.category_masks[btype]).bit_count()
+
+    def category(self, btype):
+        return Plan(self.matrix, self.mask & self.matrix.category_masks[btype])
+
+    def is_full(self):
+        return len(self) >= self.PLAN_SIZE
+
+    def category_full(self, btype):
+        return self.count(btype) >= self.CATEGORY_SIZE
+
+    def add(self, building):
+        return Plan(self.matrix, self.mask | 1 << building.index)
+
+    def remove(self, building):
+        return Plan(self.matrix, self.mask & ~(1 << building.index))
+
+    def to_dict(self):
+        """ 转换为 {建筑类型: 建筑列表} ，用于输出
+        """
+        return {btype: list(self.category(btype)) for btype in self.matrix.AREA}
+
+    def __repr__(self):
+        return '<Plan:{}>'.format(' '.join(bd.name for bd in self))
+
+
+class BuildingTable(namedtuple('BuildingTable', [
+        'names', 'types', 'base_fix', 'star', 'level', 'global_coefficient', 'income'])):
+    """ 建筑数值的只读快照，每个字段为按建筑序号排列的元组 (struct of arrays)
+    income[i] = 全局加成 * 星级收益 * 等级收益倍数，即建筑 i 不计方案内加成时的收益
+    评分只读取快照及加成索引，不修改建筑对象，可在多个线程或进程中同时使用
+    """
+    __slots__ = ()
+
+    @classmethod
+    def from_buildings(cls, buildings):
+        return cls(
+            names=tuple(bd.name for bd in buildings),
+            types=tuple(bd.building_type for bd in buildings),
+            base_fix=tuple(bd.base_fix for bd in buildings),
+            star=tuple(bd.star for bd in buildings),
+            level=tuple(bd.level for bd in buildings),
+            global_coefficient=tuple(bd.global_coefficient for bd in buildings),
+            income=tuple(bd.global_coefficient * bd.self_effect for bd in buildings),
+        )
+
+
+class InteractionTable(object):
+    """ 某一在线/离线模式下的建筑加成索引
+    sources[i] / coefficients[i] 为作用于序号 i 建筑的全部加成来源序号及系数，已按 fit_income 过滤，
+    顺序与 buffed_by 一致。评分时只需整数查表，不再遍历 Buffer 对象。
+    """
+
+    def __init__(self, matrix, online):
+        PROFILER.count('interaction_tables')
+        self.online = online
+        self.sources = []
+        self.coefficients = []
+        for target in matrix.ordered:
+            fit_buffers = [
+                buffer for buffer in target.buffed_by
+                if buffer.fit_income(target, online=online)
+            ]
+            self.sources.append(tuple(buffer.buffer_from.index for buffer in fit_buffers))
+            self.coefficients.append(tuple(buffer.coefficient for buffer in fit_buffers))
+
+    def pairs(self, index):
+        return zip(self.sources[index], self.coefficients[index])
+
+
 class BuildingMatrix(object):
 
-    AREA = {
-        Bc.RES: set(),
-        Bc.COM: set(),
-        Bc.IND: set(),
-    }
+    AREA = [Bc.RES, Bc.COM, Bc.IND]
 
-    def __init__(self, building_config):
+    def __init__(self, building_config, numeric=D):
+        """ numeric 为数值类型，Decimal 精确计算，float 快速计算
+        """
+        self.numeric = numeric
         self.buildings = {}
+        self.ordered = []
         self.indexes = {
             Bc.IND: [],
             Bc.COM: [],
             Bc.RES: [],
         }
+        self.category_masks = dict.fromkeys(self.indexes, 0)
+        self._interactions = {}
+        self._table = None
+        self.curves = BuildingConsts.LEVEL_CURVES
         self.init_building(building_config)
 
     def init_building(self, building_config):
@@ -165,28 +330,73 @@ class BuildingMatrix(object):
         2. link buildings
         """
         for item in building_config:
-            item['buffers'] = [
+            buffers = [
                 BuildingBuffer(
                     buf[0], buf[1], bind_name=buf[2] if len(buf) == 3 else None
                 )
                 for buf in item['buffers']
             ]
-            bd = Building(**item)
+            bd = Building(**dict(item, buffers=buffers, numeric=self.numeric))
+            bd.index = len(self.ordered)
+            bd.matrix = self
             self.buildings[bd.name] = bd
+            self.ordered.append(bd)
             self.indexes[bd.building_type].append(bd)
+            self.category_masks[bd.building_type] |= 1 << bd.index
         for bd in self.buildings.values():
             bd.lookup_bind(self)
+        for bd in self.buildings.values():
+            bd.bind_order = list(bd.buffed_by)
+
+    def reset(self):
+        """ 恢复为未定星状态，建筑关联保持不变，可复用于下一份配置
+        """
+        for bd in self.buildings.values():
+            bd.reset_star()
+            bd.buffed_by[:] = bd.bind_order
+        self.invalidate()
+
+    def set_curves(self, curves):
+        """ 更换等级曲线，只影响各建筑自身收益，故只需重建数值快照
+        """
+        if curves is self.curves:
+            return
+        self.curves = curves
+        for bd in self.buildings.values():
+            bd.self_effect = bd.level_income()
+        self.invalidate_table()
 
     def sort_buffer(self):
         for bd in self.buildings.values():
             bd.buffed_by.sort(key=lambda buf: buf.coefficient, reverse=True)
+        self.invalidate()
+
+    def interactions(self, online=True):
+        """ 取得加成索引，每种模式只编译一次，星级或加成顺序变化后重新编译
+        """
+        table = self._interactions.get(online)
+        if table is None:
+            table = self._interactions[online] = InteractionTable(self, online)
+        return table
+
+    def table(self):
+        """ 建筑数值快照，星级或全局加成变化后重新生成
+        """
+        if self._table is None:
+            self._table = BuildingTable.from_buildings(self.ordered)
+        return self._table
+
+    def invalidate(self):
+        self._interactions = {}
+        self._table = None
+
+    def invalidate_table(self):
+        self._table = None
 
     def put(self, building, plan=None):
-        plan = plan or copy.deepcopy(self.AREA)
-        if len(set.union(*plan.values())) >= 9:
+        plan = Plan(self) if plan is None else plan
+        if plan.is_full():
             raise MatrixFull()
-        target = plan[building.building_type]
-        if len(target) >= 3:
+        if plan.category_full(building.building_type):
             raise MatrixCategoryFull()
-        target.add(building)
-        return plan
+        return plan.add(building)
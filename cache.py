@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import json
+import time
+import sqlite3
+
+CACHE_FILE_NAME = '.jiaguomeng_cache.db'
+# 缓存文件中结果数据的总大小上限
+CACHE_MAX_BYTES = 8 * 1024 * 1024
+# 结果格式或求解结果有变化时加一，旧版本的缓存不再命中
+CACHE_VERSION = 1
+
+
+class ResultCache(object):
+    """ 求解结果的本地缓存，单个 sqlite 文件
+    以规范化配置的哈希为键，值为 plan_json 的结果。
+    结果总大小超过 max_bytes 时，按最近访问时间淘汰最久未使用的结果。
+    """
+
+    def __init__(self, path=CACHE_FILE_NAME, max_bytes=CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = self.misses = 0
+        self.conn = sqlite3.connect(path)
+        self.conn.execute(
+            'CREATE TABLE IF NOT EXISTS results ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+            'size INTEGER NOT NULL, accessed REAL NOT NULL)'
+        )
+
+    def get(self, key):
+        row = self.conn.execute('SELECT value FROM results WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        with self.conn:
+            self.conn.execute('UPDATE results SET accessed = ? WHERE key = ?', (time.time(), key))
+        return json.loads(row[0])
+
+    def put(self, key, value):
+        text = json.dumps(value, ensure_ascii=False)
+        with self.conn:
+            self.conn.execute(
+                'INSERT OR REPLACE INTO results (key, value, size, accessed) VALUES (?, ?, ?, ?)',
+                (key, text, len(text.encode()), time.time())
+            )
+            self.evict()
+
+    def evict(self):
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM results').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for key, size in self.conn.execute(
+                'SELECT key, size FROM results ORDER BY accessed').fetchall():
+            self.conn.execute('DELETE FROM results WHERE key = ?', (key,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def report(self):
+        return '缓存命中 {}, 未命中 {}'.format(self.hits, self.misses)
+
+    def close(self):
+        self.conn.close()
@@ -2,6 +2,7 @@
 # encoding: utf-8
 # author: 04
 
+from array import array
 from decimal import Decimal as D # noqa
 
 
@@ -38,10 +39,50 @@ class BufferConsts:
     ]
 
 
+def _level_curve(growth, max_level):
+    """ 按等级预先计算的等比数值表，下标为等级，0 级不使用
+    """
+    return array('d', [0.0] + [growth ** (level - 1) for level in range(1, max_level + 1)])
+
+
+def _running_total(values):
+    total, totals = 0.0, array('d', [0.0, 0.0])
+    for value in values[1:-1]:
+        total += value
+        totals.append(total)
+    return totals
+
+
+class LevelCurves(object):
+    """ 等级收益倍数及升级费用表，growth 为每升一级的增长倍数
+    默认曲线见 BuildingConsts.LEVEL_CURVES，配置文件的 等级曲线 可另行指定
+    """
+
+    def __init__(self, income_growth, cost_growth, max_level):
+        self.income_growth = income_growth
+        self.cost_growth = cost_growth
+        # income[level]: 相对 1 级的收益倍数
+        self.income = _level_curve(income_growth, max_level)
+        # upgrade_cost[level]: 由 level 级升到 level + 1 级的费用，以 1 级升 2 级的费用为单位
+        self.upgrade_cost = _level_curve(cost_growth, max_level)
+        # cost[level]: 由 1 级升到 level 级的累计费用，任意两级间的费用为两项之差
+        self.cost = _running_total(self.upgrade_cost)
+
+
 class BuildingConsts:
 
     STAR_INCOME = [0, 1, 2, 6, 24, 120]
+    MAX_LEVEL = 2000
+    # 等级收益及升级费用均为近似的等比曲线，并非游戏内的实际数值：
+    # 收益按 “主力建筑高出其他建筑 50~100 级时收益约 5 倍” 取 75 级 5 倍，
+    # 费用增长略快于收益，每 50 级约 8 倍
+    LEVEL_INCOME_GROWTH = 5 ** (1 / 75)
+    LEVEL_COST_GROWTH = 8 ** (1 / 50)
+    LEVEL_CURVES = LevelCurves(LEVEL_INCOME_GROWTH, LEVEL_COST_GROWTH, MAX_LEVEL)
+
 
+# 配置文件中各星级建筑列表的键名，依次为 1~5 星
+STAR_NAMES = ['1星', '2星', '3星', '4星', '5星']
 
 _B = BufferConsts
 
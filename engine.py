@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import heapq
+import itertools
+import multiprocessing
+
+import numpy as np
+
+from consts import BufferConsts as Bc
+
+# 浮点计算与 Decimal 计算的最大允许相对误差
+SCORE_TOLERANCE = 1e-9
+CATEGORIES = [Bc.RES, Bc.COM, Bc.IND]
+
+
+class TopK(object):
+    """ 定长最小堆，只保留收益最高的 k 个结果，内存不随方案数量增长
+    堆顶即为当前门槛，低于门槛的结果直接丢弃
+    """
+
+    def __init__(self, k):
+        self.k = k
+        self.heap = []
+        self.counter = itertools.count()
+
+    def push(self, score, item):
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap, (score, next(self.counter), item))
+        elif score > self.heap[0][0]:
+            heapq.heapreplace(self.heap, (score, next(self.counter), item))
+
+    def results(self):
+        """ 按收益降序返回 (score, item)，收益相同时先加入的排前
+        """
+        return [
+            (score, item) for score, _, item in sorted(self.heap, key=lambda x: (-x[0], x[1]))
+        ]
+
+
+class ExplosionEngine(object):
+    """ 向量化爆破引擎
+    建筑收益 = 基础系数 * (1 + 方案内加成之和), 基础系数 = 全局加成 * 星级收益
+    预先生成 建筑 x 建筑 的两两加成矩阵；best 按类别分解为 TripleTables 查表。
+    与 Decimal 计算结果的相对误差不超过 SCORE_TOLERANCE。
+    """
+
+    def __init__(self, building_matrix, online=True):
+        self.buildings = list(building_matrix.ordered)
+        self.baseline = np.array([float(income) for income in building_matrix.table().income])
+        self.buff = buff_matrix(building_matrix, online)
+        self.set_triples(category_triples(building_matrix))
+
+    def set_triples(self, triples):
+        self.triples = triples
+        self.shape = tuple(len(category) for category in triples)
+        self.size = int(np.prod(self.shape))
+
+    def snapshot(self):
+        """ 仅含 numpy 数组的精简快照，可 pickle 传给子进程，无需重新解析建筑及配置
+        """
+        return self.baseline, self.buff, self.triples
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        engine = cls.__new__(cls)
+        engine.buildings = []
+        engine.baseline, engine.buff, triples = snapshot
+        engine.set_triples(triples)
+        return engine
+
+    def tables(self):
+        """ 按类别分解的查表，首次使用时生成
+        """
+        if getattr(self, '_tables', None) is None:
+            self._tables = TripleTables(self.baseline, self.baseline[:, None] * self.buff, self.triples)
+        return self._tables
+
+    def best(self, top=2, progress=None):
+        """ 遍历全部方案，返回收益最高的 top 个 (score, plan) ，按收益降序
+        逐个住宅组合，以查表一次求出与全部商业、工业组合搭配的收益
+        """
+        return sorted_top(self.tables().best(top=top, progress=progress))
+
+    def best_parallel(self, top=2, workers=2, progress=None):
+        """ 多进程爆破，住宅组合均分为 workers * 4 个分片
+        子进程各自生成查表，保留分片内最优的 top 个方案，主进程合并
+        """
+        step = max(self.shape[0] // (workers * 4), 1)
+        shards = [(start, min(start + step, self.shape[0]), top) for start in range(0, self.shape[0], step)]
+        best = empty_top()
+        with multiprocessing.Pool(
+                workers, initializer=_init_worker, initargs=(self.snapshot(),)) as pool:
+            for (start, stop, _), shard_best in zip(shards, pool.imap(_score_shard, shards)):
+                if progress is not None:
+                    progress.update((stop - start) * self.shape[1] * self.shape[2])
+                best = merge_top(best, shard_best, top)
+        return sorted_top(best)
+
+    def to_buildings(self, plan):
+        """ 下标方案转换为 (住宅, 商业, 工业) 三组建筑，与暴力破解的 plan 结构一致
+        """
+        bds = [self.buildings[index] for index in plan]
+        return tuple(tuple(bds[offset:offset + 3]) for offset in (0, 3, 6))
+
+
+class TripleTables(object):
+    """ 按类别分解的方案收益查表
+    方案收益 = sum(single[c][t_c]) + sum(cross(c, d)[t_c, t_d]), c < d，t_c 为类别 c 所选三元组的编号
+    single[c][t]: 三元组 t 自身的收益，即基础系数与类内两两加成
+    cross(c, d)[t, u]: 类别 c 的三元组 t 与类别 d 的三元组 u 之间的相互加成，首次使用时生成
+    完整方案只需 6 次查表；固定两个类别时，第三个类别的全部三元组可一次向量化求值。
+    """
+
+    def __init__(self, baseline, pair, triples):
+        self.triples = triples
+        self.shape = tuple(len(category) for category in triples)
+        self.size = int(np.prod(self.shape))
+        pair = np.asarray(pair, dtype=float)
+        self.mutual = pair + pair.T
+        self.single = [
+            np.asarray(baseline, dtype=float)[category].sum(axis=1)
+            + pair[category[:, :, None], category[:, None, :]].sum(axis=(1, 2))
+            for category in triples
+        ]
+        self.ids = [{tuple(triple): index for index, triple in enumerate(category.tolist())} for category in triples]
+        self.members = [set(category.ravel().tolist()) for category in triples]
+        self._cross = {}
+
+    def picks(self, indexes):
+        """ 方案的建筑下标转换为各类别的三元组编号，每类须恰好 3 个建筑
+        """
+        return [
+            ids[tuple(sorted(index for index in indexes if index in members))]
+            for ids, members in zip(self.ids, self.members)
+        ]
+
+    def cross(self, c, d):
+        if c > d:
+            return self.cross(d, c).T
+        table = self._cross.get((c, d))
+        if table is None:
+            table = self._cross[c, d] = sum(
+                self.mutual[np.ix_(self.triples[c][:, a], self.triples[d][:, b])]
+                for a in range(3) for b in range(3)
+            )
+        return table
+
+    def third(self, picks, category):
+        """ 其余类别固定为 picks 时，category 类别每个三元组对应的方案收益
+        只需固定三元组与各候选之间的加成，无需生成完整的 cross 表
+        """
+        triples = self.triples[category]
+        scores = self.single[category].copy()
+        others = [c for c in range(len(self.triples)) if c != category]
+        for c in others:
+            fixed = self.triples[c][picks[c]]
+            scores += self.mutual[triples[:, :, None], fixed[None, None, :]].sum(axis=(1, 2))
+            scores += self.single[c][picks[c]]
+        for c, d in itertools.combinations(others, 2):
+            fixed_c, fixed_d = self.triples[c][picks[c]], self.triples[d][picks[d]]
+            scores += self.mutual[fixed_c[:, None], fixed_d[None, :]].sum()
+        return scores
+
+    def coordinate_ascent(self, picks):
+        """ 轮流固定两个类别，为第三个类别换上最优的三元组，直到没有类别可以提升
+        返回 (收益, picks)
+        """
+        picks = list(picks)
+        score = float(self.third(picks, 0)[picks[0]])
+        improved = True
+        while improved:
+            improved = False
+            for category in range(len(self.triples)):
+                scores = self.third(picks, category)
+                best = int(np.argmax(scores))
+                if scores[best] > score * (1 + SCORE_TOLERANCE):
+                    picks[category], score = best, float(scores[best])
+                    improved = True
+        return score, picks
+
+    def first_scores(self, first):
+        """ 第一个类别固定为三元组 first 时，与其余两类全部组合搭配的方案收益，按 (第二类, 第三类) 展平
+        """
+        if getattr(self, '_rest', None) is None:
+            self._rest = self.single[1][:, None] + self.single[2][None, :] + self.cross(1, 2)
+        return (
+            self._rest + self.single[0][first]
+            + self.cross(0, 1)[first][:, None] + self.cross(0, 2)[first][None, :]
+        ).ravel()
+
+    def first_plans(self, first, keep):
+        """ first_scores 中下标为 keep 的方案，转换为建筑下标
+        """
+        second, third = np.unravel_index(keep, self.shape[1:])
+        return np.hstack([
+            np.repeat(self.triples[0][first][None, :], len(keep), axis=0),
+            self.triples[1][second],
+            self.triples[2][third],
+        ])
+
+    def best(self, top=2, start=0, stop=None, progress=None):
+        """ 枚举第一个类别的三元组 [start, stop)，每个三元组与其余两类的全部组合一次查表求值
+        返回收益最高的 top 个 (plans, scores)，plans 为建筑下标，与 ExplosionEngine.plans 一致
+        """
+        stop = self.shape[0] if stop is None else stop
+        best = empty_top()
+        for first in range(start, stop):
+            scores = self.first_scores(first)
+            keep = np.argpartition(scores, -top)[-top:] if len(scores) > top else np.arange(len(scores))
+            best = merge_top(best, (self.first_plans(first, keep), scores[keep]), top)
+            if progress is not None:
+                progress.update(len(scores))
+        return best
+
+
+class JointEngine(ExplosionEngine):
+    """ 在线/离线联合爆破
+    两种模式各有一份 TripleTables，共用同一组三元组；
+    逐个住宅组合查表得到两种模式下与全部商业、工业组合搭配的收益，先求出该组合内的前沿再并入总前沿。
+    baselines 为 (在线, 离线) 两组按建筑序号排列的基础系数，在线与离线的全局加成不同，需由调用方给出。
+    """
+
+    MODES = (True, False)
+
+    def __init__(self, building_matrix, baselines):
+        self.buildings = list(building_matrix.ordered)
+        # baseline[m] / buff[m] 为第 m 种模式的基础系数及加成矩阵
+        self.baseline = [np.array(baseline, dtype=float) for baseline in baselines]
+        self.buff = [buff_matrix(building_matrix, online) for online in self.MODES]
+        self.set_triples(category_triples(building_matrix))
+        self.mode_tables = [
+            TripleTables(baseline, baseline[:, None] * buff, self.triples)
+            for baseline, buff in zip(self.baseline, self.buff)
+        ]
+
+    def pareto(self, progress=None):
+        """ 遍历全部方案，返回在线/离线收益的帕累托前沿 [(scores, plan)]，按在线收益降序
+        """
+        front = empty_top(2)
+        for first in range(self.shape[0]):
+            online, offline = [tables.first_scores(first) for tables in self.mode_tables]
+            # 绝大多数组合已被总前沿占优：先与前沿两端的方案比较粗筛，再以二分查找剔除，只对剩余组合排序
+            if len(front[1]):
+                (top_online, low_offline), (low_online, top_offline) = front[1][0], front[1][-1]
+                keep = np.flatnonzero(
+                    ((online > top_online) | (offline > low_offline))
+                    & ((online > low_online) | (offline > top_offline))
+                )
+            else:
+                keep = np.arange(len(online))
+            if progress is not None:
+                progress.update(len(online))
+            scores = np.column_stack([online[keep], offline[keep]])
+            survive = ~dominated_by(front[1], scores)
+            if not survive.any():
+                continue
+            keep, scores = pareto_front(keep[survive], scores[survive])
+            front = pareto_front(
+                np.vstack([front[0], self.mode_tables[0].first_plans(first, keep)]),
+                np.vstack([front[1], scores]),
+            )
+        return list(zip(front[1], front[0]))
+
+
+def buff_matrix(building_matrix, online):
+    """ buff[i, j]: 建筑 j 在方案内时，对建筑 i 的加成系数
+    """
+    size = len(building_matrix.ordered)
+    buff = np.zeros((size, size))
+    table = building_matrix.interactions(online)
+    for target in building_matrix.ordered:
+        for source, coefficient in table.pairs(target.index):
+            buff[target.index, source] += float(coefficient)
+    return buff
+
+
+def category_triples(building_matrix):
+    triples = []
+    for btype in CATEGORIES:
+        indices = [bd.index for bd in building_matrix.indexes[btype]]
+        triples.append(np.array(list(itertools.combinations(indices, 3)), dtype=np.intp))
+    return triples
+
+
+def pareto_front(plans, scores):
+    """ 两个目标均不被其他方案超过的方案，按第一目标降序
+    先按 (第一目标, 第二目标) 降序排列，第二目标严格超过此前最大值者即在前沿上
+    """
+    order = np.lexsort((-scores[:, 1], -scores[:, 0]))
+    plans, scores = plans[order], scores[order]
+    second = scores[:, 1]
+    keep = np.ones(len(second), dtype=bool)
+    keep[1:] = second[1:] > np.maximum.accumulate(second)[:-1]
+    return plans[keep], scores[keep]
+
+
+def dominated_by(front, scores):
+    """ scores 中两个目标均不高于前沿上某个方案的行
+    front 为 pareto_front 的结果，第一目标降序、第二目标升序，
+    第一目标不低于 x 的前沿方案为一段前缀，其中第二目标最高的即前缀的最后一个
+    """
+    if not len(front):
+        return np.zeros(len(scores), dtype=bool)
+    count = np.searchsorted(-front[:, 0], -scores[:, 0], side='right')
+    return (count > 0) & (front[np.maximum(count - 1, 0), 1] >= scores[:, 1])
+
+
+def empty_top(columns=None):
+    if columns:
+        return np.empty((0, 9), dtype=np.intp), np.empty((0, columns))
+    return np.empty((0, 9), dtype=np.intp), np.empty(0)
+
+
+def merge_top(best, batch, top):
+    """ 合并两组 (plans, scores)，只保留收益最高的 top 个
+    """
+    plans = np.vstack([best[0], batch[0]])
+    scores = np.concatenate([best[1], batch[1]])
+    if len(scores) > top:
+        keep = np.argpartition(scores, -top)[-top:]
+        plans, scores = plans[keep], scores[keep]
+    return plans, scores
+
+
+def sorted_top(best):
+    plans, scores = best
+    order = np.argsort(-scores, kind='stable')
+    return [(scores[index], plans[index]) for index in order]
+
+
+_worker_engine = None
+
+
+def _init_worker(snapshot):
+    global _worker_engine
+    _worker_engine = ExplosionEngine.from_snapshot(snapshot)
+
+
+def _score_shard(shard):
+    start, stop, top = shard
+    return _worker_engine.tables().best(top=top, start=start, stop=stop)
@@ -9,3 +9,7 @@ class MatrixFull(Exception):
 
 class MatrixCategoryFull(Exception):
     pass
+
+
+class TimeBudgetExceeded(Exception):
+    pass
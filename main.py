@@ -2,42 +2,81 @@
 # encoding: utf-8
 # author: 04
 
+import json
+import math
+import heapq
+import time
+import hashlib
+import random
 import operator
 import itertools
 from decimal import Decimal as D # noqa
 from functools import reduce
-from queue import PriorityQueue as PQ # noqa
+from collections import OrderedDict
 
 import yaml
 import click
-from scipy.special import comb
-from tqdm import tqdm
 
-from buildings import BuildingMatrix, GlobalBuffer
-from consts import BUILDING_INFO, BufferConsts as Bc
-from errors import MatrixCategoryFull, MatrixFull
+from buildings import BuildingMatrix, GlobalBuffer, Plan
+from cache import ResultCache, CACHE_FILE_NAME, CACHE_VERSION
+from profiler import PROFILER
+from consts import BUILDING_INFO, STAR_NAMES, BuildingConsts, LevelCurves, BufferConsts as Bc
+from errors import MatrixCategoryFull, MatrixFull, TimeBudgetExceeded
 
 CUSTOM_FILE_NAME = 'jiaguomeng.yml'
+# 单次求解内方案评分缓存的最大条目数
+SCORE_CACHE_SIZE = 4096
+PLAN_LINES = [('住宅', Bc.RES), ('商业', Bc.COM), ('工业', Bc.IND)]
+# 升星评估中，城市任务建筑加成每次增加的系数
+QUEST_STEP = 1
+# 爆破进度条格式
+PROGRESS_FORMAT = '{percentage:3.0f}%, {elapsed}<{remaining}|{bar}|{n_fmt}/{total_fmt}, {rate_fmt}{postfix}'
 
 
 class CalcJiaGuoMeng(object):
     """ 主函数，收集用户信息并完成计算
     """
 
-    def __init__(self, online_mod, conf, only):
-        self.building_matrix = BuildingMatrix(BUILDING_INFO)
-        self.custom_config = self.read_custom_config(conf)
+    def __init__(self, online_mod, conf, only, exact=False, numeric=float, building_matrix=None):
+        """ 默认以 float 计算，exact 时最终方案再以 Decimal 复算并报告偏差
+        conf 为配置文件路径或已解析的配置 dict
+        building_matrix 可传入已建立关联的建筑矩阵，重置星级后复用，省去重建
+        """
+        self.numeric = numeric
+        self.exact = exact
+        self.conf = conf
+        self.boosts = {}
+        with PROFILER.phase('building_matrix'):
+            if building_matrix is None:
+                building_matrix = BuildingMatrix(BUILDING_INFO, numeric=numeric)
+            else:
+                building_matrix.reset()
+        self.building_matrix = building_matrix
+        with PROFILER.phase('config_load'):
+            self.custom_config = self.read_custom_config(conf)
         self.online_mod = online_mod
         self.only_one_building = only
-        self.fill_global_buffer()
+        with PROFILER.phase('fill_global_buffer'):
+            self.fill_global_buffer()
+
+    def load_config(self, conf_file):
+        if isinstance(conf_file, dict):
+            return conf_file
+        with open(conf_file) as conf_stream:
+            return yaml.load(conf_stream, Loader=yaml.SafeLoader)
 
     def read_custom_config(self, conf_file):
-        config = yaml.load(open(conf_file), Loader=yaml.SafeLoader)
-        for config_name in ['1星', '2星', '3星', '4星', '5星']:
+        config = self.load_config(conf_file)
+        self.building_matrix.set_curves(self._read_level_curves(config.get('等级曲线')))
+        for config_name in STAR_NAMES:
             bnames = config[config_name] or ''
             star = int(config_name[:1])
             for name in bnames.split():
                 self.building_matrix.buildings[name].set_star(star)
+        # 等级可选，未填写的建筑按 1 级计算
+        self.levels = {name: int(level) for name, level in (config.get('等级') or {}).items()}
+        for name, level in self.levels.items():
+            self.building_matrix.buildings[name].set_level(level)
         # 星级全部确定后，可确定所有加成具体数值，即可对buff排序
         self.building_matrix.sort_buffer()
         effect_trans = {
@@ -53,6 +92,29 @@ class CalcJiaGuoMeng(object):
             self._read_custom_binds('quests', config['城市任务建筑加成'])
         )
 
+    def _read_level_curves(self, curve_conf):
+        """ 等级曲线可选，收益/费用 写作 [倍数, 级数]，即每升 级数 级变为 倍数 倍，未填写的沿用默认曲线
+        """
+        if not curve_conf:
+            return BuildingConsts.LEVEL_CURVES
+        growths = []
+        for key, default in [('收益', BuildingConsts.LEVEL_INCOME_GROWTH), ('费用', BuildingConsts.LEVEL_COST_GROWTH)]:
+            value = curve_conf.get(key)
+            if value is None:
+                growths.append(default)
+                continue
+            try:
+                factor, levels = (float(item) for item in value)
+                if factor <= 0 or levels <= 0:
+                    raise ValueError
+                growths.append(factor ** (1 / levels))
+            except (TypeError, ValueError):
+                raise ValueError('等级曲线 %s should be [factor, levels] of positive numbers.' % key)
+        try:
+            return LevelCurves(growths[0], growths[1], BuildingConsts.MAX_LEVEL)
+        except OverflowError:
+            raise ValueError('等级曲线 grows too fast for level %s.' % BuildingConsts.MAX_LEVEL)
+
     def _read_custom_buffers(self, global_type, buffer_conf):
         buffer_trans = {
             '在线': Bc.ONL,
@@ -62,38 +124,114 @@ class CalcJiaGuoMeng(object):
             '工业': Bc.IND,
         }
         return [
-            GlobalBuffer(global_type, buffer_type, D(buffer_conf.get(conf_key)))
+            GlobalBuffer(global_type, buffer_type, self.numeric(buffer_conf.get(conf_key)))
             for conf_key, buffer_type in buffer_trans.items()
-            if buffer_conf.get(conf_key) is not 0
+            if buffer_conf.get(conf_key) != 0
         ]
 
     def _read_custom_binds(self, global_type, bind_config):
         return [
-            GlobalBuffer(global_type, Bc.SGL, D(coefficient), building_name)
+            GlobalBuffer(global_type, Bc.SGL, self.numeric(coefficient), building_name)
             for building_name, coefficient in bind_config.items()
-            if coefficient is not 0
+            if coefficient != 0
         ]
 
     def fill_global_buffer(self):
         for building in self.building_matrix.buildings.values():
-            match_effects = {
-                effects_name: list(filter(
-                    lambda buf: buf.fit_income(building, online=self.online_mod), buffer_list
-                ))
-                for effects_name, buffer_list in self.global_effects.items()
-            }
-            global_coefficient = reduce(operator.mul, [
-                D(1) + sum([buffer.coefficient for buffer in buffer_list])
-                for buffer_list in match_effects.values()
-            ])
-            building.global_coefficient = global_coefficient
+            building.set_global_coefficient(self.global_coefficient(building, self.online_mod))
+
+    def global_coefficient(self, building, online):
+        match_effects = {
+            effects_name: list(filter(
+                lambda buf: buf.fit_income(building, online=online), buffer_list
+            ))
+            for effects_name, buffer_list in self.global_effects.items()
+        }
+        return reduce(operator.mul, [
+            1 + sum([buffer.coefficient for buffer in buffer_list])
+            for buffer_list in match_effects.values()
+        ])
+
+    def cache_key(self, **options):
+        """ 以实际生效的输入生成缓存键
+        包括各建筑星级、等级、等级收益曲线、政策/照片/城市任务加成及城市任务建筑加成、在线/离线、only 以及求解参数，
+        与配置文件的书写顺序、注释及黑名单无关；包含 CACHE_VERSION，代码改变结果后旧缓存自然失效
+        """
+        effects = sorted(
+            [effect_name, buf.buffer_type, buf.bind_name or '', '{:.12g}'.format(float(buf.coefficient))]
+            for effect_name, buffer_list in self.global_effects.items() for buf in buffer_list
+        )
+        inputs = {
+            'version': CACHE_VERSION,
+            'stars': {bd.name: bd.star for bd in self.building_matrix.ordered},
+            'levels': {bd.name: bd.level for bd in self.building_matrix.ordered},
+            'income_growth': '{:.12g}'.format(self.building_matrix.curves.income_growth),
+            'effects': effects,
+            'online': self.online_mod,
+            'only': self.only_one_building,
+            'options': options,
+        }
+        return hashlib.sha256(
+            json.dumps(inputs, sort_keys=True, ensure_ascii=False).encode()
+        ).hexdigest()
+
+    def income_weights(self):
+        """ 浮点评分用的基础系数及两两加成收益，按建筑序号索引
+        baseline[i] = 全局加成 * 星级收益
+        pair[i][j] = baseline[i] * 建筑 j 对建筑 i 的加成系数之和
+        方案收益 = sum(baseline[i]) + sum(pair[i][j])，i, j 均在方案内
+        """
+        ordered = self.building_matrix.ordered
+        table = self.building_matrix.interactions(self.online_mod)
+        baseline = [float(income) for income in self.building_matrix.table().income]
+        pair = [[0.0] * len(ordered) for _ in ordered]
+        for index in range(len(ordered)):
+            for source, coefficient in table.pairs(index):
+                pair[index][source] += baseline[index] * float(coefficient)
+        return baseline, pair
+
+    def boost(self, building, factor):
+        self.boosts[building.name] = factor
+        building.set_global_coefficient(building.global_coefficient * factor)
+
+    def reload_config(self):
+        """ 建筑矩阵被其他计算器复用 (building_matrix 参数) 后，重新应用本计算器的星级、等级及加成
+        """
+        self.building_matrix.reset()
+        self.read_custom_config(self.conf)
+        self.fill_global_buffer()
+        for name, factor in self.boosts.items():
+            self.boost(self.building_matrix.buildings[name], factor)
+
+    def exact_twin(self):
+        """ 以 Decimal 重建同一配置的计算器，用于复算最终方案
+        建筑序号与当前计算器一致，Plan.mask 可直接沿用
+        """
+        twin = self.__class__(self.online_mod, self.conf, self.only_one_building, numeric=D)
+        for name, factor in self.boosts.items():
+            twin.boost(twin.building_matrix.buildings[name], factor)
+        return twin
+
+    def report_drift(self, score, exact_score):
+        from engine import SCORE_TOLERANCE
+        drift = abs(D(score) - exact_score)
+        print('Decimal 复算: {}, 浮点偏差: {:.3e}'.format(exact_score, drift))
+        if drift > D(SCORE_TOLERANCE) * abs(exact_score):
+            print('Warning: float score {} drifts from decimal score {}'.format(score, exact_score))
 
 
 class ExplosionMixin(object):
-    """ 暴力破解，高消耗
-    仅用作验证，不做实际运行使用，未做数据结构简化的优化
+    """ 暴力破解
+    explosion 为逐个方案的计算，高消耗，仅用作验证
+    fast_explosion 使用 ExplosionEngine 向量化计算，可日常使用
     """
 
+    def plan_title(self, rank):
+        ordinals = ['First', 'Second', 'Third']
+        if rank < len(ordinals):
+            return 'The {} Good Plan'.format(ordinals[rank])
+        return 'The No.{} Good Plan'.format(rank + 1)
+
     def print_plan(self, total_score, main_bd, plan):
         print('总加成: {}'.format(total_score))
         print('主建筑: {}'.format(main_bd.name))
@@ -107,50 +245,108 @@ class ExplosionMixin(object):
                 bds=' '.join(bd.name for bd in plan[index])
             ))
 
-    def explosion(self):
-        """ 网上的暴力破解方法
-        result 最大范围限定为3，随时取出最后一个，即保证前两个是最优化和次优化配置
+    def explosion(self, top=2):
+        """ 网上的暴力破解方法，逐个方案调用 explosion_calc
+        速度远慢于 fast_explosion，只在 bench.py 的一致性检查中于小目录上校验向量化爆破
+        返回收益最高的 top 个 (score, (main_bd, plan))，按收益降序
         """
+        from engine import TopK
         _m = self.building_matrix
-        res = _m.indexes[Bc.RES]
-        com = _m.indexes[Bc.COM]
-        ind = _m.indexes[Bc.IND]
         search_space = itertools.product(
-            itertools.combinations(res, 3),
-            itertools.combinations(com, 3),
-            itertools.combinations(ind, 3)
+            itertools.combinations(_m.indexes[Bc.RES], 3),
+            itertools.combinations(_m.indexes[Bc.COM], 3),
+            itertools.combinations(_m.indexes[Bc.IND], 3)
         )
-        search_space_size = comb(len(ind), 3) * comb(
-            len(com), 3) * comb(len(res), 3)
-        print('Total iterations:', search_space_size)
-        results = PQ()
-        for plan in tqdm(
-                search_space,
-                total=search_space_size,
-                bar_format='{percentage:3.0f}%, {elapsed}<{remaining}|{bar}|{n_fmt}/{total_fmt}, {rate_fmt}{postfix}',
-                ncols=80):
+        results = TopK(top)
+        for plan in search_space:
             prod = self.explosion_calc(plan)
-            results.put((-1 * prod[0], prod[1], plan))
-        first_good = results.get()
-        second_good = results.get()
-        print('The First Good Plan')
-        self.print_plan(*first_good)
-        print('The Second Good Plan')
-        self.print_plan(*second_good)
+            results.push(prod[0], (prod[1], plan))
+        return results.results()
+
+    def fast_explosion(self, top=2, workers=1):
+        """ 向量化暴力破解
+        浮点批量打分找出最优的 top 个方案，exact 时再用 Decimal 复算，确认误差在 SCORE_TOLERANCE 以内
+        workers > 1 时按住宅组合分片，多进程计算
+        """
+        from tqdm import tqdm
+        from engine import ExplosionEngine
+        engine = ExplosionEngine(self.building_matrix, online=self.online_mod)
+        print('Total iterations:', engine.size)
+        with tqdm(
+                total=engine.size,
+                bar_format=PROGRESS_FORMAT,
+                ncols=80) as progress:
+            with PROFILER.phase('explosion'):
+                if workers > 1:
+                    results = engine.best_parallel(top=top, workers=workers, progress=progress)
+                else:
+                    results = engine.best(top=top, progress=progress)
+        PROFILER.count('plans_scored', engine.size)
+        scorer = self.exact_twin() if self.exact else self
+        with PROFILER.phase('print'):
+            for rank, (score, plan_index) in enumerate(results):
+                plan = engine.to_buildings(plan_index)
+                plan = tuple(
+                    tuple(scorer.building_matrix.ordered[bd.index] for bd in line) for line in plan
+                )
+                total_score, main_bd = scorer.explosion_calc(plan)
+                print(self.plan_title(rank))
+                if self.exact:
+                    self.report_drift(score, total_score)
+                self.print_plan(total_score, main_bd, plan)
+
+    def pareto_explosion(self, ratio=0.5):
+        """ 在线/离线联合爆破，每个方案只枚举一次，同时得到两种模式的收益
+        输出帕累托前沿，以及按在线时长占比 ratio 加权后最优的方案
+        加权收益为线性组合，其最优方案必在前沿上，无需另行搜索
+        """
+        from tqdm import tqdm
+        from engine import JointEngine
+        baselines = [
+            [float(self.global_coefficient(bd, online) * bd.self_effect) for bd in self.building_matrix.ordered]
+            for online in JointEngine.MODES
+        ]
+        engine = JointEngine(self.building_matrix, baselines)
+        print('Total iterations:', engine.size)
+        with tqdm(
+                total=engine.size,
+                bar_format=PROGRESS_FORMAT,
+                ncols=80) as progress:
+            with PROFILER.phase('explosion'):
+                front = engine.pareto(progress=progress)
+        PROFILER.count('plans_scored', engine.size)
+        print('帕累托前沿 ({} 个方案):'.format(len(front)))
+        for (online_score, offline_score), plan_index in front:
+            print('在线 {:.2f} 离线 {:.2f}  {}'.format(online_score, offline_score, ' | '.join(
+                ' '.join(bd.name for bd in line) for line in engine.to_buildings(plan_index)
+            )))
+        weighted = [ratio * scores[0] + (1 - ratio) * scores[1] for scores, _ in front]
+        best = max(range(len(front)), key=weighted.__getitem__)
+        (online_score, offline_score), plan_index = front[best]
+        print('在线时长占比 {:.0%} 的最优方案'.format(ratio))
+        print('加权收益: {:.2f}, 在线收益: {:.2f}, 离线收益: {:.2f}'.format(
+            weighted[best], online_score, offline_score))
+        print('建筑列表:')
+        for cn, line in zip(['住宅', '商业', '工业'], engine.to_buildings(plan_index)):
+            print('{idt}{cn}:{bds}'.format(idt=' ' * 8, cn=cn, bds=' '.join(bd.name for bd in line)))
 
     def explosion_calc(self, plan):
+        """ 返回 (方案总收益, 收益最高的建筑)，只读取建筑快照及加成索引，不修改建筑对象
+        """
+        PROFILER.count('plans_scored')
         plan_buildings = [bd for cat in plan for bd in cat]
-        for bd in plan_buildings:
-            active_buffers = [
-                buffer for buffer in bd.buffed_by
-                if buffer.buffer_from in plan_buildings and
-                buffer.fit_income(bd)
-            ]
-            bd.result = (
-                D(1) + sum(buf.coefficient for buf in active_buffers)
-            ) * bd.global_coefficient
-        priority_order = sorted(plan_buildings, key=lambda x: x.result)
-        return sum(bd.result for bd in plan_buildings), priority_order[-1]
+        plan_mask = Plan.from_buildings(self.building_matrix, plan_buildings).mask
+        table = self.building_matrix.interactions(self.online_mod)
+        income = self.building_matrix.table().income
+        results = [
+            (1 + sum(
+                coefficient for source, coefficient in table.pairs(bd.index)
+                if plan_mask >> source & 1
+            )) * income[bd.index]
+            for bd in plan_buildings
+        ]
+        main_index = max(range(len(results)), key=results.__getitem__)
+        return sum(results), plan_buildings[main_index]
 
 
 class PickUpMixin(object):
@@ -158,133 +354,388 @@ class PickUpMixin(object):
     基于最低成本考虑，主建筑总是唯一一个，允许有次升建筑。
     """
     debug = {}
+    helper_buildings = []
+
+    def run(self, refine=None, iterations=1000, beam_width=1, beam_depth=3, cache=None):
+        confirmed_plan = self.cached_solve(
+            cache, self.solve, refine=refine, iterations=iterations, beam_width=beam_width, beam_depth=beam_depth)
+        with PROFILER.phase('print'):
+            self.print_plan(confirmed_plan)
+        score_cache = confirmed_plan.get('report', {}).get('score_cache')
+        if score_cache and not confirmed_plan.get('cached'):
+            click.echo('评分缓存: 命中 {hits}, 未命中 {misses}, 命中率 {hit_rate:.1%}'.format(**score_cache), err=True)
+
+    def cached_solve(self, cache, solve, **options):
+        """ 先查结果缓存，未命中时求解并写入缓存
+        Decimal 复算的结果不做缓存
+        """
+        if cache is None or self.exact:
+            return solve(**options)
+        key = self.cache_key(solve=solve.__name__, **options)
+        data = cache.get(key)
+        if data is not None:
+            return dict(self.plan_from_json(data), cached=True)
+        confirmed_plan = solve(**options)
+        cache.put(key, self.plan_json(confirmed_plan))
+        return confirmed_plan
 
-    def run(self):
+    def solve(self, refine=None, iterations=1000, beam_width=1, beam_depth=3):
         """ 计算并寻找最优解
         计算方式：
         1. 首先确定每个建筑全局加成
         2. 计算每个建筑最高加成建筑的组合,及加成总倍率,确定主力建筑
         3. 合并次要方案，并计算总体建筑价值，基于建筑价值排序去除低价值建筑。
         总体建筑价值 = 建筑直接收益系数 + 建筑加成间接收益系数
-        4. 输出方案及升级价值排序。
+        合并以 beam_width 宽、beam_depth 层的束搜索进行，默认 1 宽 3 层即逐轮保留最优方案
+        4. 可选 refine: 对合并结果做同类建筑替换的局部搜索 (hill / anneal)，iterations 为迭代预算
+        5. 输出方案及升级价值排序。
         升级价值 == 建筑直接收益系数
         """
-        building_plans = self.first_building_plans()
+        self.reset_score_cache()
+        with PROFILER.phase('first_building_plans'):
+            building_plans = self.first_building_plans()
         self.helper_buildings = [info['bd'] for info in building_plans[30:]]
-        main_plan = building_plans[0]
-        if self.only_one_building:
-            # 一般主力建筑等级高出其他建筑50~100级，高出往期主力建筑20~50级，主力建筑系数调整5倍
-            main_plan['bd'].global_coefficient *= 5
-        # 执行三次优化, 逐步扩大搜索范围，下探到较差的组合中确认是否有互补情况
-        total_income, counted_detail = self.count_total_income(main_plan['plan'])
-        consider_plan = confirmed_plan = {
-            'plan': main_plan['plan'],
+        self.boost_main_building(building_plans)
+        # 逐层扩大搜索范围，下探到较差的组合中确认是否有互补情况
+        _, plan = self.beam_search(building_plans, width=beam_width, depth=beam_depth)
+        total_income, counted_detail = self.score_plan(plan)
+        confirmed_plan = {
+            'plan': plan,
             'total_income': total_income,
             'detail': counted_detail
         }
-        seek_ranges = [4, 7, 10]
-        for seek_range in seek_ranges:
-            value_plans = building_plans[1:seek_range]
-            for pick_plan in value_plans:
-                merged_plan = self.merge_plans(confirmed_plan['plan'], pick_plan['plan'])
-                merge_income, merge_detail = self.count_total_income(merged_plan)
-                if merge_income > consider_plan['total_income']:
-                    consider_plan = {
-                        'plan': merged_plan,
-                        'total_income': merge_income,
-                        'detail': merge_detail
-                    }
-            confirmed_plan = consider_plan
+        if refine:
+            with PROFILER.phase('local_search'):
+                refined_plan = self.local_search(confirmed_plan['plan'], method=refine, iterations=iterations)
+                refined_income, refined_detail = self.score_plan(refined_plan)
+            if refined_income > confirmed_plan['total_income']:
+                confirmed_plan = {
+                    'plan': refined_plan,
+                    'total_income': refined_income,
+                    'detail': refined_detail
+                }
+        # 只为最终方案生成 explain 数据
+        _, confirmed_plan['detail'] = self.count_total_income(confirmed_plan['plan'], explain=True)
+        if self.exact:
+            confirmed_plan = self.rescore_exact(confirmed_plan)
+        self.sort_detail(confirmed_plan)
+        confirmed_plan['report'] = {'score_cache': self.score_cache_report()}
+        return confirmed_plan
+
+    def beam_search(self, building_plans, width=1, depth=3):
+        """ 束搜索合并方案，返回 (收益, 方案)
+        第 d 层 (从 0 起) 将束内每个方案分别与 building_plans[1:4 + 3d] 合并，
+        合并结果以 Plan (建筑位掩码) 去重后整层一次打分，连同束内原有方案取收益最高的 width 个进入下一层。
+        收益相同时原有方案优先，width=1, depth=3 即原先 [4, 7, 10] 三轮合并的结果。
+        """
+        if width < 1:
+            raise ValueError('Beam width %s should be at least 1.' % width)
+        if depth < 0:
+            raise ValueError('Beam depth %s should not be negative.' % depth)
+        baseline, pair = self.income_weights()
+        for bd in self.helper_buildings:
+            # 与 count_total_income 一致，辅助建筑只计算间接收益
+            baseline[bd.index] = 0.0
+            pair[bd.index] = [0.0] * len(pair)
+        main_plan = building_plans[0]['plan']
+        beam = [(self.score_plans([main_plan], baseline, pair)[0], main_plan)]
+        for level in range(depth):
+            with PROFILER.phase('beam_level_{}'.format(level)):
+                seen = set(plan for _, plan in beam)
+                children = []
+                for _, plan in beam:
+                    for pick_plan in building_plans[1:4 + 3 * level]:
+                        merged_plan = self.merge_plans(plan, pick_plan['plan'])
+                        if merged_plan not in seen:
+                            seen.add(merged_plan)
+                            children.append(merged_plan)
+                scores = self.score_plans(children, baseline, pair)
+                beam = sorted(beam + list(zip(scores, children)), key=lambda x: x[0], reverse=True)[:width]
+        return beam[0]
+
+    def score_plans(self, plans, baseline, pair):
+        """ 按建筑序号的基础系数及两两加成收益，一次为一层的全部方案打分
+        """
+        PROFILER.count('beam_scored', len(plans))
+        scores = []
+        for plan in plans:
+            indexes = [bd.index for bd in plan]
+            scores.append(sum(baseline[i] + sum(pair[i][j] for j in indexes) for i in indexes))
+        return scores
+
+    def reset_score_cache(self):
+        self.score_cache = OrderedDict()
+        self.score_cache_hits = self.score_cache_misses = 0
+
+    def score_plan(self, plan):
+        """ 带缓存的方案评分，以 Plan 为键，仅在一次求解内有效
+        同一方案在各轮合并中反复出现时直接取用，超过 SCORE_CACHE_SIZE 时淘汰最久未用的方案
+        """
+        result = self.score_cache.get(plan)
+        if result is not None:
+            self.score_cache.move_to_end(plan)
+            self.score_cache_hits += 1
+            PROFILER.count('score_cache_hits')
+            return result
+        self.score_cache_misses += 1
+        PROFILER.count('score_cache_misses')
+        result = self.score_cache[plan] = self.count_total_income(plan)
+        if len(self.score_cache) > SCORE_CACHE_SIZE:
+            self.score_cache.popitem(last=False)
+        return result
+
+    def score_cache_report(self):
+        """ 本次求解中方案评分缓存的命中情况，写入 confirmed_plan['report']
+        """
+        total = self.score_cache_hits + self.score_cache_misses
+        return {
+            'hits': self.score_cache_hits,
+            'misses': self.score_cache_misses,
+            'hit_rate': self.score_cache_hits / total if total else 0.0,
+        }
+
+    def local_search(self, plan, method='hill', iterations=1000, seed=0, deadline=None):
+        """ 同类建筑单个替换的局部搜索
+        link[k] = sum(pair[k][j] + pair[j][k])，j 在方案内，每次替换后增量更新，
+        任一替换的收益变化只需常数次查表，无需重新计算整个方案。
+        hill: 每轮执行提升最大的替换，无可提升时结束
+        anneal: 模拟退火，每轮随机尝试一次替换，按温度接受变差的替换，返回过程中的最优方案
+        block: 见 block_search，一次替换整个类别的三个建筑
+        deadline 为 time.perf_counter() 时刻，到时即返回当前最优方案
+        """
+        if method == 'block':
+            return self.block_search(plan)
+        baseline, pair = self.income_weights()
+        size = len(baseline)
+        chosen = set(bd.index for bd in plan)
+        link = [sum(pair[k][j] + pair[j][k] for j in chosen) for k in range(size)]
+        score = sum(baseline[i] for i in chosen) + sum(pair[i][j] for i in chosen for j in chosen)
+        lines = [[bd.index for bd in self.building_matrix.indexes[btype]] for btype in self.building_matrix.AREA]
+
+        def delta(out, into):
+            return (
+                baseline[into] + pair[into][into] + link[into] - pair[into][out] - pair[out][into]
+                - baseline[out] - link[out] + pair[out][out]
+            )
+
+        def swap(out, into):
+            chosen.remove(out)
+            chosen.add(into)
+            for k in range(size):
+                link[k] += pair[k][into] + pair[into][k] - pair[k][out] - pair[out][k]
+
+        def moves():
+            return [
+                (out, into) for line in lines for out in line if out in chosen
+                for into in line if into not in chosen
+            ]
+
+        best_score, best_chosen = score, set(chosen)
+        if method == 'hill':
+            for _ in range(iterations):
+                candidates = moves()
+                if not candidates or deadline is not None and time.perf_counter() > deadline:
+                    break
+                gain, out, into = max((delta(out, into), out, into) for out, into in candidates)
+                if gain <= 0:
+                    break
+                swap(out, into)
+                score += gain
+            best_score, best_chosen = score, chosen
+        elif method == 'anneal':
+            rand = random.Random(seed)
+            # 温度从方案收益的 2% 按几何级数降到 0.01%
+            start_temp, end_temp = score * 0.02, score * 0.0001
+            for step in range(iterations):
+                candidates = moves()
+                if not candidates or deadline is not None and time.perf_counter() > deadline:
+                    break
+                temperature = start_temp * (end_temp / start_temp) ** (step / max(iterations - 1, 1))
+                out, into = rand.choice(candidates)
+                gain = delta(out, into)
+                if gain > 0 or rand.random() < math.exp(gain / temperature):
+                    swap(out, into)
+                    score += gain
+                    if score > best_score:
+                        best_score, best_chosen = score, set(chosen)
+        else:
+            raise ValueError('Local search method %s is not allowed.' % method)
+        return Plan.from_buildings(
+            self.building_matrix, [self.building_matrix.ordered[index] for index in best_chosen])
+
+    def block_search(self, plan):
+        """ 按类别分块的坐标上升
+        以 TripleTables 轮流固定两个类别，一次求出第三个类别全部三元组的方案收益并换上最优者，
+        直到任何类别都无法提升。方案不满 9 个建筑时原样返回。
+        """
+        if not plan.is_full():
+            return plan
+        from engine import TripleTables, category_triples
+        baseline, pair = self.income_weights()
+        tables = TripleTables(baseline, pair, category_triples(self.building_matrix))
+        _, picks = tables.coordinate_ascent(tables.picks([bd.index for bd in plan]))
+        ordered = self.building_matrix.ordered
+        return Plan.from_buildings(self.building_matrix, [
+            ordered[index] for category, pick in zip(tables.triples, picks) for index in category[pick].tolist()
+        ])
+
+    def rescore_exact(self, confirmed_plan):
+        """ 以 Decimal 复算最终方案并报告浮点偏差
+        """
+        twin = self.exact_twin()
+        plan = Plan(twin.building_matrix, confirmed_plan['plan'].mask)
+        total_income, detail = twin.count_total_income(plan)
+        self.report_drift(confirmed_plan['total_income'], total_income)
+        return {
+            'plan': plan,
+            'total_income': total_income,
+            'detail': detail,
+        }
+
+    def sort_detail(self, confirmed_plan):
         confirmed_plan['sorted_detail'] = sorted([
             (bd, value['direct_income'], value['indirect_income'])
             for bd, value in confirmed_plan['detail'].items()
         ], key=lambda x: x[1] + x[2], reverse=True)
-        self.print_plan(confirmed_plan)
+
+    def boost_main_building(self, building_plans=None):
+        """ only 模式下调整主力建筑系数，各求解模式共用，同一计算器只调整一次
+        一般主力建筑等级高出其他建筑50~100级，高出往期主力建筑20~50级，主力建筑系数调整5倍
+        配置了等级时收益已按等级计算，不再估算
+        """
+        if not self.only_one_building or self.levels or self.boosts:
+            return
+        if building_plans is None:
+            building_plans = self.first_building_plans()
+        self.boost(building_plans[0]['bd'], 5)
 
     def first_building_plans(self):
         calc_completed = []
+        income = self.building_matrix.table().income
         ordered_building_list = sorted(
             self.building_matrix.buildings.values(),
-            key=lambda bd: bd.global_coefficient * bd.self_effect,
+            key=lambda bd: income[bd.index],
             reverse=True
         )
+        table = self.building_matrix.interactions(self.online_mod)
         for bd in ordered_building_list:
             plan = self.building_matrix.put(bd)
-            building_effect = D(1)
-            ordered_buffer_buildings = sorted(bd.buffed_by, key=lambda x: x.coefficient, reverse=True)
-            for buffer in ordered_buffer_buildings:
-                if not buffer.fit_income(bd, online=self.online_mod):
-                    continue
+            building_effect = 1
+            # 加成索引与 buffed_by 同序，sort_buffer 后即为系数降序
+            for source, coefficient in table.pairs(bd.index):
                 try:
-                    plan = self.building_matrix.put(buffer.buffer_from, plan)
+                    plan = self.building_matrix.put(self.building_matrix.ordered[source], plan)
                 except MatrixCategoryFull:
                     continue
                 except MatrixFull:
                     break
-                building_effect += buffer.coefficient
+                building_effect += coefficient
             calc_completed.append({
                 'bd': bd,
                 'max_bd_effect': building_effect,
-                'income_coefficient': bd.global_coefficient * bd.self_effect * building_effect,
+                'income_coefficient': income[bd.index] * building_effect,
                 'plan': plan,
             })
         calc_completed.sort(key=lambda x: x['income_coefficient'], reverse=True)
         return calc_completed
 
     def count_total_income(self, plan, explain=False):
+        PROFILER.count('count_total_income')
+        PROFILER.count('plans_scored')
         flat_plan = {
             bd: {
                 'direct_income': 0,
                 'indirect_income': 0,
-            } for line in plan.values() for bd in line}
+            } for bd in plan}
         explain_data = {}
+        ordered = self.building_matrix.ordered
+        table = self.building_matrix.interactions(self.online_mod)
+        income = self.building_matrix.table().income
         for bd, info in flat_plan.items():
             if bd in self.helper_buildings:
                 # 辅助建筑只计算间接受益
                 continue
-            bd_buffed = D(1)
-            bd_baseline = bd.global_coefficient * bd.self_effect
-            for buf in bd.buffed_by:
-                if not buf.fit_income(bd, online=self.online_mod):
-                    continue
-                if buf.buffer_from in flat_plan:
-                    bd_buffed += buf.coefficient
-                    flat_plan[buf.buffer_from]['indirect_income'] += (
-                        bd_baseline * buf.coefficient)
+            bd_buffed = 1
+            bd_baseline = income[bd.index]
+            for source, coefficient in table.pairs(bd.index):
+                if plan.mask >> source & 1:
+                    buffer_from = ordered[source]
+                    bd_buffed += coefficient
+                    flat_plan[buffer_from]['indirect_income'] += (
+                        bd_baseline * coefficient)
                     if explain:
-                        effect_num = bd_baseline * buf.coefficient
+                        effect_num = bd_baseline * coefficient
                         bd_explain = explain_data.setdefault(bd, {'buffed_from': [], 'buffer_to': []})
-                        bd_explain['buffed_from'].append((buf.buffer_from, effect_num))
-                        buffer_from_explain = explain_data.setdefault(buf.buffer_from, {'buffed_from': [], 'buffer_to': []})
+                        bd_explain['buffed_from'].append((buffer_from, effect_num))
+                        buffer_from_explain = explain_data.setdefault(buffer_from, {'buffed_from': [], 'buffer_to': []})
                         buffer_from_explain['buffer_to'].append((bd, effect_num))
-                        self.debug['explain'] = explain_data
             info['direct_income'] = bd_baseline * bd_buffed
+        if explain:
+            # 写入实例自身，不修改类属性，多个计算器互不影响
+            self.debug = {'explain': explain_data}
         total_income = sum([info['direct_income'] for info in flat_plan.values()])
         return total_income, flat_plan
 
     def merge_plans(self, main_plan, pick_plan):
         """ 尝试合并两个plan, 合并后剔除最低加成的建筑
         """
-        merging_plan = {key: set.union(main_plan[key], pick_plan[key]) for key in main_plan}
-        total_income, detail = self.count_total_income(merging_plan, explain=True)
-        for line_name, bd_set in merging_plan.items():
-            if len(bd_set) > 3:
+        merging_plan = main_plan | pick_plan
+        total_income, detail = self.score_plan(merging_plan)
+        for line_name in self.building_matrix.AREA:
+            line = merging_plan.category(line_name)
+            if len(line) > Plan.CATEGORY_SIZE:
                 last_bds = sorted(
-                    list(bd_set),
+                    line,
                     key=lambda x: detail[x]['direct_income'] + detail[x]['indirect_income'],
                     reverse=True
-                )[3:]
-                merging_plan[line_name] = bd_set.difference(set(last_bds))
+                )[Plan.CATEGORY_SIZE:]
+                for bd in last_bds:
+                    merging_plan = merging_plan.remove(bd)
         return merging_plan
 
+    def plan_json(self, confirmed_plan):
+        """ 转换为可 JSON 序列化的结果
+        """
+        plan = confirmed_plan['plan'].to_dict()
+        result = {
+            'plan': {cn: [bd.name for bd in plan[bd_type]] for cn, bd_type in PLAN_LINES},
+            'total_income': float(confirmed_plan['total_income']),
+            'detail': [{
+                'name': bd.name,
+                'direct_income': float(direct),
+                'indirect_income': float(indirect),
+            } for bd, direct, indirect in confirmed_plan['sorted_detail']],
+        }
+        if 'report' in confirmed_plan:
+            result['report'] = confirmed_plan['report']
+        return result
+
+    def plan_from_json(self, data):
+        """ plan_json 的逆转换，用于输出缓存的结果
+        """
+        buildings = self.building_matrix.buildings
+        confirmed_plan = {
+            'plan': Plan.from_buildings(self.building_matrix, [
+                buildings[name] for names in data['plan'].values() for name in names
+            ]),
+            'total_income': data['total_income'],
+            'sorted_detail': [
+                (buildings[item['name']], item['direct_income'], item['indirect_income'])
+                for item in data['detail']
+            ],
+        }
+        if 'report' in data:
+            confirmed_plan['report'] = data['report']
+        return confirmed_plan
+
     def print_plan(self, confirmed_plan):
         """
         """
         print("建筑方案：")
-        bd_types = [('住宅', Bc.RES), ('商业', Bc.COM), ('工业', Bc.IND)]
-        for cn, bd_type in bd_types:
+        plan = confirmed_plan['plan'].to_dict()
+        for cn, bd_type in PLAN_LINES:
             print(f'''{cn}: {''.join([
-                '{:<{len}}'.format(bd.name, len=10-len(bd.name)) for bd in confirmed_plan['plan'][bd_type]
+                '{:<{len}}'.format(bd.name, len=10-len(bd.name)) for bd in plan[bd_type]
             ])}''')
         print('=' * 80)
         titles = ['建筑名称', '直接收益', '间接收益']
@@ -312,6 +763,591 @@ class PickUpMixin(object):
 
 
 
+class BranchBoundMixin(object):
+    """ 分支定界，精确求解
+    方案收益 = sum(建筑基础系数) + sum(方案内两两加成收益)，加成收益均非负。
+    按 住宅/商业/工业 依次决定每个候选建筑选或不选，
+    对部分方案估算收益上界，上界不超过当前最优方案的分支直接剪除，结果即为最优解。
+    """
+
+    def branch_and_bound(self, incumbent=None, deadline=None, prepare=True):
+        """ incumbent 为已知方案 (收益, 建筑序号列表)，低于其收益的分支直接剪除
+        deadline 为 time.perf_counter() 时刻，超时抛出 TimeBudgetExceeded，bb_best 保留已找到的最优方案
+        prepare 为 False 时沿用已有的 prepare_bound 结果
+        """
+        start = time.perf_counter()
+        if prepare:
+            with PROFILER.phase('prepare_bound'):
+                self.prepare_bound()
+        self.bb_nodes = self.bb_pruned = 0
+        self.bb_best = incumbent or (-1, [])
+        self.bb_deadline = deadline
+        with PROFILER.phase('branch_and_bound'):
+            self._branch([], 0, 0, 3, [0.0] * len(self.bb_buildings), 0.0)
+        elapsed = time.perf_counter() - start
+        PROFILER.count('branch_nodes', self.bb_nodes)
+        PROFILER.count('branch_pruned', self.bb_pruned)
+        best_score, best_plan = self.bb_best
+        plan = Plan.from_buildings(
+            self.building_matrix, [self.bb_buildings[index] for index in best_plan])
+        return plan, {
+            'nodes': self.bb_nodes,
+            'pruned': self.bb_pruned,
+            'elapsed': elapsed,
+            'score': best_score,
+        }
+
+    def prepare_bound(self):
+        """ 建筑基础系数及加成收益预计算
+        incoming[i] 为 (来源建筑, 加成收益) 列表，沿用加成索引 (即 sort_buffer 后 buffed_by) 的降序
+        """
+        self.bb_categories = [Bc.RES, Bc.COM, Bc.IND]
+        self.bb_buildings = self.building_matrix.ordered
+        table = self.building_matrix.interactions(self.online_mod)
+        self.bb_baseline, self.bb_pair = self.income_weights()
+        self.bb_incoming = []
+        for index in range(len(self.bb_buildings)):
+            # 同一来源的多个加成已合并，按合并后的收益重新排序
+            sources = dict.fromkeys(table.sources[index])
+            self.bb_incoming.append(sorted(
+                ((source, self.bb_pair[index][source]) for source in sources),
+                key=lambda x: x[1], reverse=True
+            ))
+        # 候选顺序按单建筑收益降序，优先展开的分支即为贪心方案
+        self.bb_candidates = [
+            sorted(
+                (bd.index for bd in self.building_matrix.indexes[btype]),
+                key=lambda x: self.bb_baseline[x] + self.bb_pair[x][x],
+                reverse=True,
+            ) for btype in self.bb_categories
+        ]
+
+    def _gain(self, index, link):
+        """ 单个建筑加入方案时，不含与后续建筑相互加成的收益
+        """
+        return self.bb_baseline[index] + self.bb_pair[index][index] + link[index]
+
+    def _upper_bound(self, category, pos, slots, link):
+        """ 乐观上界：每个类别取估值最高的若干候选
+        候选估值 = 自身收益 + 与已选建筑的相互加成 + 来自其他候选的最高 (剩余槽位 - 1) 个加成
+        """
+        remaining = slots + 3 * (len(self.bb_categories) - category - 1)
+        open_candidates = [self.bb_candidates[category][pos:]] + self.bb_candidates[category + 1:]
+        eligible = set(itertools.chain(*open_candidates))
+        bound = 0.0
+        for candidates, take in zip(open_candidates, [slots] + [3] * (len(open_candidates) - 1)):
+            values = []
+            for index in candidates:
+                value = self._gain(index, link)
+                picked = 0
+                for source, effect in self.bb_incoming[index]:
+                    if picked >= remaining - 1:
+                        break
+                    if source != index and source in eligible:
+                        value += effect
+                        picked += 1
+                values.append(value)
+            values.sort(reverse=True)
+            bound += sum(values[:take])
+        return bound
+
+    def _branch(self, chosen, category, pos, slots, link, score):
+        self.bb_nodes += 1
+        if self.bb_deadline is not None and time.perf_counter() > self.bb_deadline:
+            raise TimeBudgetExceeded()
+        if slots == 0:
+            category, pos, slots = category + 1, 0, 3
+            if category == len(self.bb_categories):
+                if score > self.bb_best[0]:
+                    self.bb_best = (score, list(chosen))
+                return
+        candidates = self.bb_candidates[category]
+        if len(candidates) - pos < slots:
+            return
+        if score + self._upper_bound(category, pos, slots, link) <= self.bb_best[0]:
+            self.bb_pruned += 1
+            return
+        index = candidates[pos]
+        new_link = list(link)
+        for other in range(len(link)):
+            new_link[other] += self.bb_pair[other][index] + self.bb_pair[index][other]
+        chosen.append(index)
+        self._branch(chosen, category, pos + 1, slots - 1, new_link, score + self._gain(index, link))
+        chosen.pop()
+        self._branch(chosen, category, pos + 1, slots, link, score)
+
+    def solve_branch(self, incumbent=None):
+        self.boost_main_building()
+        plan, report = self.branch_and_bound(incumbent=incumbent)
+        total_income, detail = self.count_total_income(plan)
+        confirmed_plan = {
+            'plan': plan,
+            'total_income': total_income,
+            'detail': detail,
+        }
+        if self.exact:
+            confirmed_plan = self.rescore_exact(confirmed_plan)
+        self.sort_detail(confirmed_plan)
+        confirmed_plan['report'] = report
+        return confirmed_plan
+
+    def run_branch(self, cache=None):
+        confirmed_plan = self.cached_solve(cache, self.solve_branch)
+        with PROFILER.phase('print'):
+            print('分支定界: 节点 {nodes}, 剪枝 {pruned}, 耗时 {elapsed:.3f}s'.format(**confirmed_plan['report']))
+            self.print_plan(confirmed_plan)
+
+
+class MilpMixin(object):
+    """ 混合整数规划，精确求解
+    x[i] 为建筑 i 是否入选，y[i, j] (i < j) 为建筑 i、j 是否同时入选，
+    目标 max sum((baseline[i] + pair[i][i]) * x[i]) + sum((pair[i][j] + pair[j][i]) * y[i, j])。
+    两两收益均非负，只需 y[i, j] <= x[i]、y[i, j] <= x[j]，y 可取连续值；
+    另加 sum(y[i, j], j 属于类别 d) <= 类别 d 内可与 i 同选的数量 * x[i]，收紧线性松弛。
+    由 scipy 自带的 HiGHS 求解，返回证明最优的方案。
+    """
+
+    def milp_model(self):
+        from scipy.sparse import coo_matrix
+        from scipy.optimize import LinearConstraint, Bounds
+        baseline, pair = self.income_weights()
+        size = len(baseline)
+        categories = [Bc.RES, Bc.COM, Bc.IND]
+        category_of = {bd.index: category for category, btype in enumerate(categories)
+                       for bd in self.building_matrix.indexes[btype]}
+        pairs = [
+            (i, j, pair[i][j] + pair[j][i])
+            for i in range(size) for j in range(i + 1, size)
+            if pair[i][j] + pair[j][i] > 0
+        ]
+        cost = [-(baseline[i] + pair[i][i]) for i in range(size)] + [-weight for _, _, weight in pairs]
+        rows, cols, values, upper = [], [], [], []
+
+        def add_row(entries, bound):
+            for col, value in entries:
+                rows.append(len(upper))
+                cols.append(col)
+                values.append(value)
+            upper.append(bound)
+
+        for category, btype in enumerate(categories):
+            add_row([(bd.index, 1) for bd in self.building_matrix.indexes[btype]], Plan.CATEGORY_SIZE)
+        lower = [Plan.CATEGORY_SIZE] * len(categories)
+        linked = {}
+        for offset, (i, j, _) in enumerate(pairs, size):
+            add_row([(offset, 1), (i, -1)], 0)
+            add_row([(offset, 1), (j, -1)], 0)
+            linked.setdefault((i, category_of[j]), []).append(offset)
+            linked.setdefault((j, category_of[i]), []).append(offset)
+        for (i, category), offsets in linked.items():
+            partners = Plan.CATEGORY_SIZE - (category_of[i] == category)
+            add_row([(offset, 1) for offset in offsets] + [(i, -partners)], 0)
+        lower += [-float('inf')] * (len(upper) - len(lower))
+        constraints = LinearConstraint(
+            coo_matrix((values, (rows, cols)), shape=(len(upper), len(cost))).tocsr(), lower, upper)
+        integrality = [1] * size + [0] * len(pairs)
+        return cost, constraints, integrality, Bounds(0, 1)
+
+    def solve_milp(self, time_limit=None):
+        from scipy.optimize import milp
+        start = time.perf_counter()
+        self.boost_main_building()
+        with PROFILER.phase('milp_model'):
+            cost, constraints, integrality, bounds = self.milp_model()
+        options = {} if time_limit is None else {'time_limit': time_limit}
+        with PROFILER.phase('milp'):
+            result = milp(cost, constraints=constraints, integrality=integrality, bounds=bounds, options=options)
+        if result.x is None:
+            raise ValueError('MILP solver failed: %s' % result.message)
+        plan = Plan.from_buildings(self.building_matrix, [
+            bd for bd in self.building_matrix.ordered if result.x[bd.index] > 0.5
+        ])
+        report = {
+            'status': result.message,
+            'nodes': getattr(result, 'mip_node_count', 0),
+            'gap': getattr(result, 'mip_gap', 0.0),
+            'variables': len(cost),
+            'constraints': constraints.A.shape[0],
+            'elapsed': time.perf_counter() - start,
+            'score': -result.fun,
+        }
+        PROFILER.count('milp_nodes', report['nodes'])
+        total_income, detail = self.count_total_income(plan)
+        confirmed_plan = {
+            'plan': plan,
+            'total_income': total_income,
+            'detail': detail,
+        }
+        if self.exact:
+            confirmed_plan = self.rescore_exact(confirmed_plan)
+        self.sort_detail(confirmed_plan)
+        confirmed_plan['report'] = report
+        return confirmed_plan
+
+    def run_milp(self, cache=None):
+        confirmed_plan = self.cached_solve(cache, self.solve_milp)
+        with PROFILER.phase('print'):
+            print('混合整数规划: 变量 {variables}, 约束 {constraints}, 节点 {nodes}, 耗时 {elapsed:.3f}s'.format(
+                **confirmed_plan['report']))
+            self.print_plan(confirmed_plan)
+
+
+class AnytimeMixin(object):
+    """ 限时求解
+    立即给出首要建筑的贪心方案，之后在时间预算内逐步改进：
+    1. 逐步扩大合并范围，与挑选模式相同的方案合并
+    2. 爬山局部搜索
+    3. 以当前方案为下界的分支定界，完成即证明最优
+    每得到更优的方案或上界即产出一次当前状态，调用方可随时停止迭代。
+    """
+    seek_ranges = [4, 7, 10, 15, 20, 30]
+
+    def anytime(self, time_budget=0.2):
+        """ 生成器，产出 {'plan', 'total_income', 'detail', 'stage', 'bound', 'gap', 'elapsed'}
+        bound 为收益上界，未知时为 None；gap = (bound - total_income) / bound
+        """
+        start = time.perf_counter()
+        deadline = start + time_budget
+        self.reset_score_cache()
+        state = {'bound': None}
+
+        def update(stage, plan=None):
+            if plan is not None:
+                total_income, detail = self.score_plan(plan)
+                if 'plan' in state and total_income <= state['total_income']:
+                    return False
+                state.update(plan=plan, total_income=total_income, detail=detail)
+            bound = state['bound']
+            state.update(
+                stage=stage,
+                gap=None if bound is None else max(bound - state['total_income'], 0) / bound,
+                elapsed=time.perf_counter() - start,
+            )
+            return True
+
+        with PROFILER.phase('first_building_plans'):
+            building_plans = self.first_building_plans()
+        # 不设置辅助建筑，评分与分支定界一致，为方案的真实收益
+        self.boost_main_building(building_plans)
+        update('greedy', building_plans[0]['plan'])
+        yield dict(state)
+        with PROFILER.phase('merge'):
+            for seek_range in self.seek_ranges:
+                for pick_plan in building_plans[1:seek_range]:
+                    if time.perf_counter() > deadline:
+                        return
+                    if update('merge', self.merge_plans(state['plan'], pick_plan['plan'])):
+                        yield dict(state)
+        if time.perf_counter() > deadline:
+            return
+        with PROFILER.phase('local_search'):
+            refined = update('local_search', self.local_search(state['plan'], method='hill', deadline=deadline))
+        if refined:
+            yield dict(state)
+        with PROFILER.phase('prepare_bound'):
+            self.prepare_bound()
+            state['bound'] = self._upper_bound(0, 0, 3, [0.0] * len(self.bb_buildings))
+        update(state['stage'])
+        yield dict(state)
+        incumbent = (state['total_income'], [bd.index for bd in state['plan']])
+        try:
+            plan, report = self.branch_and_bound(incumbent=incumbent, deadline=deadline, prepare=False)
+        except TimeBudgetExceeded:
+            if self.bb_best[0] > incumbent[0]:
+                update('branch', Plan.from_buildings(
+                    self.building_matrix, [self.bb_buildings[index] for index in self.bb_best[1]]))
+                yield dict(state)
+            return
+        state['bound'] = report['score']
+        update('branch', plan) or update('branch')
+        yield dict(state)
+
+    def solve_anytime(self, time_budget=0.2, on_progress=None):
+        """ 耗尽 anytime 生成器，返回时间预算内的最优方案，report 中给出上界及最优性差距
+        """
+        improvements = 0
+        for state in self.anytime(time_budget):
+            improvements += 1
+            if on_progress is not None:
+                on_progress(state)
+        confirmed_plan = {
+            'plan': state['plan'],
+            'total_income': state['total_income'],
+            'detail': state['detail'],
+        }
+        _, confirmed_plan['detail'] = self.count_total_income(confirmed_plan['plan'], explain=True)
+        if self.exact:
+            confirmed_plan = self.rescore_exact(confirmed_plan)
+        self.sort_detail(confirmed_plan)
+        confirmed_plan['report'] = {
+            'stage': state['stage'],
+            'bound': state['bound'],
+            'gap': state['gap'],
+            'elapsed': state['elapsed'],
+            'improvements': improvements,
+            'score_cache': self.score_cache_report(),
+        }
+        return confirmed_plan
+
+    def run_anytime(self, time_budget=0.2):
+        def on_progress(state):
+            click.echo('[{:7.1f}ms] {:<12} {:.2f}{}'.format(
+                state['elapsed'] * 1000, state['stage'], state['total_income'],
+                '' if state['gap'] is None else ', gap {:.3%}'.format(state['gap'])
+            ), err=True)
+
+        confirmed_plan = self.solve_anytime(time_budget, on_progress=on_progress)
+        with PROFILER.phase('print'):
+            self.print_plan(confirmed_plan)
+
+
+class SensitivityMixin(object):
+    """ 升星评估
+    对当前配置逐个尝试单个建筑升一星 (可选城市任务建筑加成增加 QUEST_STEP)，求出新的最优方案及收益变化。
+    所有变体共用当前计算器的建筑矩阵，只重置星级，不重建建筑关联；
+    分支定界以当前最优方案在变体下的收益为初始下界，剪枝更早。
+    """
+
+    def upgrade_variants(self, config, quests=False):
+        """ 产出 (说明, 建筑名称, 变体配置)
+        """
+        for star_name, next_name in zip(STAR_NAMES, STAR_NAMES[1:]):
+            names = (config[star_name] or '').split()
+            for name in names:
+                variant = dict(config)
+                variant[star_name] = ' '.join(other for other in names if other != name)
+                variant[next_name] = ' '.join((config[next_name] or '').split() + [name])
+                yield '{} {}→{}'.format(name, star_name, next_name), name, variant
+        if quests:
+            binds = config['城市任务建筑加成']
+            for name, coefficient in binds.items():
+                variant = dict(config)
+                variant['城市任务建筑加成'] = dict(binds, **{name: coefficient + QUEST_STEP})
+                yield '{} 城市任务+{:.0%}'.format(name, QUEST_STEP), name, variant
+
+    def sensitivity(self, quests=False):
+        """ 返回 (当前最优方案, 按收益增量降序的变体结果列表)
+        """
+        config = self.load_config(self.conf)
+        base_plan = self.solve_branch()
+        base_income = float(base_plan['total_income'])
+        base_names = set(bd.name for bd in base_plan['plan'])
+        results = []
+        try:
+            for label, name, variant in self.upgrade_variants(config, quests):
+                calculater = self.__class__(
+                    self.online_mod, variant, self.only_one_building, building_matrix=self.building_matrix)
+                warm_plan = calculater.local_search(Plan.from_buildings(calculater.building_matrix, [
+                    calculater.building_matrix.buildings[base_name] for base_name in base_names]))
+                incumbent = (float(calculater.count_total_income(warm_plan)[0]), [bd.index for bd in warm_plan])
+                confirmed_plan = calculater.solve_branch(incumbent=incumbent)
+                results.append({
+                    'upgrade': label,
+                    'building': name,
+                    'total_income': float(confirmed_plan['total_income']),
+                    'delta': float(confirmed_plan['total_income']) - base_income,
+                    'plan': calculater.plan_json(confirmed_plan)['plan'],
+                    'plan_changed': set(bd.name for bd in confirmed_plan['plan']) != base_names,
+                    'nodes': confirmed_plan['report']['nodes'],
+                })
+        finally:
+            # 变体共用并重置了建筑矩阵，恢复当前配置
+            self.reload_config()
+        results.sort(key=lambda x: x['delta'], reverse=True)
+        return base_plan, results
+
+    def run_sensitivity(self, quests=False, limit=None):
+        start = time.perf_counter()
+        base_plan, results = self.sensitivity(quests)
+        elapsed = time.perf_counter() - start
+        print('当前最优收益: {:.2f}'.format(float(base_plan['total_income'])))
+        print('=' * 80)
+        for item in results[:limit]:
+            layout = ' | '.join(' '.join(names) for names in item['plan'].values())
+            print('{:<24}{:>14.2f}{:>+14.2f}{:>+9.2%}  {}'.format(
+                item['upgrade'], item['total_income'], item['delta'],
+                item['delta'] / float(base_plan['total_income']),
+                layout if item['plan_changed'] else '方案不变'))
+        print('=' * 80)
+        click.echo('{} 个变体, 搜索节点 {}, 耗时 {:.3f}s'.format(
+            len(results), sum(item['nodes'] for item in results), elapsed), err=True)
+
+
+class UpgradeMixin(object):
+    """ 升级预算规划
+    建筑直接收益 = 星级收益 * 等级收益倍数 * 全局加成 * (1 + 方案内加成)，方案收益为直接收益之和。
+    升级某个建筑只按等级收益倍数放大它自己的直接收益，各建筑的升级收益互相独立，
+    预算分配即分组背包：每个建筑为一组，组内选择升级的级数，费用及收益均查建筑矩阵的等级曲线。
+    """
+
+    def upgrade_options(self, detail, budget):
+        """ 产出 (建筑, 升级后等级数组, 累计费用数组, 累计收益增量数组)，下标 0 为不升级
+        """
+        import numpy as np
+        curves = self.building_matrix.curves
+        income_table = np.frombuffer(curves.income)
+        cost_table = np.frombuffer(curves.cost)
+        for bd, info in detail.items():
+            level = bd.level
+            stop = int(np.searchsorted(cost_table, cost_table[level] + budget, side='right'))
+            levels = np.arange(level, stop)
+            costs = cost_table[level:stop] - cost_table[level]
+            gains = float(info['direct_income']) * (income_table[level:stop] / income_table[level] - 1)
+            yield bd, levels, costs, gains
+
+    def relaxed_curve(self, options):
+        """ 不要求逐级、允许只升部分级数时，按 收益/费用 从高到低取用各级升级的 (累计费用, 累计收益) 曲线
+        任意预算下以 np.interp 插值，其值不低于这些建筑实际可得的最大收益增量
+        """
+        import numpy as np
+        if not options:
+            return np.zeros(1), np.zeros(1)
+        costs = np.concatenate([np.diff(option[2]) for option in options])
+        gains = np.concatenate([np.diff(option[3]) for option in options])
+        order = np.argsort(-gains / costs, kind='stable')
+        return np.concatenate([[0], np.cumsum(costs[order])]), np.concatenate([[0], np.cumsum(gains[order])])
+
+    def greedy_upgrades(self, options, budget):
+        """ 按每一级的 收益/费用 从高到低逐级升级，某个建筑的下一级超出预算后不再升级该建筑
+        返回可行方案的收益增量，作为精确求解的下界
+        """
+        def ratio(index, step):
+            _, _, costs, gains = options[index]
+            return -(gains[step] - gains[step - 1]) / (costs[step] - costs[step - 1])
+
+        queue = [(ratio(index, 1), index, 1) for index, option in enumerate(options) if len(option[2]) > 1]
+        heapq.heapify(queue)
+        spent, gained = 0.0, 0.0
+        while queue:
+            _, index, step = heapq.heappop(queue)
+            _, _, costs, gains = options[index]
+            cost = costs[step] - costs[step - 1]
+            if spent + cost > budget:
+                continue
+            spent += cost
+            gained += gains[step] - gains[step - 1]
+            if step + 1 < len(costs):
+                heapq.heappush(queue, (ratio(index, step + 1), index, step + 1))
+        return gained
+
+    def upgrade_knapsack(self, options, budget):
+        """ 精确求解分组背包，返回各建筑升级的级数
+        收益加上其余建筑的上界 (relaxed_curve) 仍不及贪心可行解 (greedy_upgrades) 的选择不可能最优：
+        先以此剔除每个建筑单独不可能最优的级数，通常只剩最优级数附近的一段，收益很低的建筑则几乎不受限制；
+        再按剩余级数从少到多，逐个建筑将已有的 (费用, 收益) 状态与剩余级数组合，
+        剔除被占优 (费用不低而收益不高) 及不可能最优的状态。收益随级数递增，
+        最后一个建筑只需为每个状态取预算内的最高级数，无需组合。parents 记录每个状态的来源及级数，用于回溯。
+        """
+        import numpy as np
+        from engine import SCORE_TOLERANCE
+        lower = self.greedy_upgrades(options, budget) * (1 - SCORE_TOLERANCE)
+        allowed = []
+        for index, (_, _, costs, gains) in enumerate(options):
+            others = self.relaxed_curve(options[:index] + options[index + 1:])
+            allowed.append(np.flatnonzero(gains + np.interp(budget - costs, *others) >= lower))
+        order = sorted(range(len(options)), key=lambda index: len(allowed[index]))
+        spent, gained = np.zeros(1), np.zeros(1)
+        parents = []
+        for position, index in enumerate(order[:-1]):
+            _, _, costs, gains = options[index]
+            steps = allowed[index]
+            spent = (spent[:, None] + costs[steps][None, :]).ravel()
+            gained = (gained[:, None] + gains[steps][None, :]).ravel()
+            rest = [options[other] for other in order[position + 1:]]
+            upper = gained + np.interp(budget - spent, *self.relaxed_curve(rest))
+            keep = np.flatnonzero((spent <= budget) & (upper >= lower))
+            keep = keep[np.lexsort((-gained[keep], spent[keep]))]
+            best_so_far = np.maximum.accumulate(gained[keep])
+            keep = keep[np.concatenate([[True], gained[keep][1:] > best_so_far[:-1]])]
+            spent, gained = spent[keep], gained[keep]
+            parent, step = np.divmod(keep, len(steps))
+            parents.append((parent, steps[step]))
+            lower = max(lower, float(gained.max()) * (1 - SCORE_TOLERANCE))
+        _, _, costs, gains = options[order[-1]]
+        last = np.searchsorted(costs, budget - spent, side='right') - 1
+        state = int(np.argmax(gained + gains[last]))
+        result = {order[-1]: int(last[state])}
+        for index, (parent, step) in zip(reversed(order[:-1]), reversed(parents)):
+            result[index] = int(step[state])
+            state = int(parent[state])
+        return [result[index] for index in range(len(options))]
+
+    def plan_upgrades(self, confirmed_plan, budget):
+        """ 在预算内分配方案内建筑的升级，使方案收益最大 (精确解)
+        升级顺序按每一级的 收益/费用 从高到低排列，中途停止时收益也尽量高
+        """
+        _, detail = self.count_total_income(confirmed_plan['plan'])
+        options = list(self.upgrade_options(detail, budget))
+        steps = self.upgrade_knapsack(options, budget)
+        spent = sum(costs[step] for (_, _, costs, _), step in zip(options, steps))
+
+        # 各建筑每级的 收益/费用 随等级递减，按比值归并即为逐级升级顺序
+        queue = []
+        for index, ((bd, levels, costs, gains), step) in enumerate(zip(options, steps)):
+            for current in range(1, step + 1):
+                cost = costs[current] - costs[current - 1]
+                gain = gains[current] - gains[current - 1]
+                queue.append((-(gain / cost) if cost else -math.inf, index, current))
+        heapq.heapify(queue)
+        sequence = []
+        while queue:
+            _, index, current = heapq.heappop(queue)
+            bd, levels, costs, gains = options[index]
+            cost = costs[current] - costs[current - 1]
+            gain = gains[current] - gains[current - 1]
+            if sequence and sequence[-1]['name'] == bd.name:
+                sequence[-1].update(
+                    target=int(levels[current]), cost=sequence[-1]['cost'] + cost,
+                    gain=sequence[-1]['gain'] + gain)
+            else:
+                sequence.append({
+                    'name': bd.name, 'level': int(levels[current - 1]), 'target': int(levels[current]),
+                    'cost': float(cost), 'gain': float(gain),
+                })
+        upgrades = [{
+            'name': bd.name,
+            'level': int(levels[0]),
+            'target': int(levels[step]),
+            'cost': float(costs[step]),
+            'gain': float(gains[step]),
+        } for (bd, levels, costs, gains), step in zip(options, steps)]
+        total_income = float(confirmed_plan['total_income'])
+        gain = sum(item['gain'] for item in upgrades)
+        return {
+            'budget': budget,
+            'spent': float(spent),
+            'total_income': total_income,
+            'upgraded_income': total_income + gain,
+            'gain': gain,
+            'upgrades': upgrades,
+            'sequence': sequence,
+        }
+
+    def run_upgrade(self, budget, limit=None):
+        start = time.perf_counter()
+        confirmed_plan = self.solve_branch()
+        upgrade = self.plan_upgrades(confirmed_plan, budget)
+        elapsed = time.perf_counter() - start
+        print('建筑方案: {}'.format(' | '.join(
+            ' '.join(names) for names in self.plan_json(confirmed_plan)['plan'].values())))
+        print('=' * 80)
+        print('升级分配')
+        for item in sorted(upgrade['upgrades'], key=lambda x: x['gain'], reverse=True):
+            print('{:<10}{:>6} → {:<6}{:>16.2f}{:>+16.2f}'.format(
+                item['name'], item['level'], item['target'], item['cost'], item['gain']))
+        print('=' * 80)
+        print('升级顺序')
+        for item in upgrade['sequence'][:limit]:
+            print('{:<10}{:>6} → {:<6}{:>16.2f}{:>+16.2f}'.format(
+                item['name'], item['level'], item['target'], item['cost'], item['gain']))
+        if limit is not None and len(upgrade['sequence']) > limit:
+            print('... 其余 {} 段'.format(len(upgrade['sequence']) - limit))
+        print('=' * 80)
+        print('预算 {:.2f}, 花费 {:.2f}'.format(upgrade['budget'], upgrade['spent']))
+        print('总系数 {:.2f} → {:.2f} ({:+.2%})'.format(
+            upgrade['total_income'], upgrade['upgraded_income'], upgrade['gain'] / upgrade['total_income']))
+        click.echo('耗时 {:.3f}s'.format(elapsed), err=True)
+
 
 class CalcByExplosion(CalcJiaGuoMeng, ExplosionMixin):
     pass
@@ -321,23 +1357,223 @@ class CalcByPick(CalcJiaGuoMeng, PickUpMixin):
     pass
 
 
-@click.command()
+class CalcByBranch(CalcJiaGuoMeng, BranchBoundMixin, PickUpMixin):
+    pass
+
+
+class CalcByMilp(CalcJiaGuoMeng, MilpMixin, PickUpMixin):
+    pass
+
+
+class CalcByAnytime(CalcJiaGuoMeng, AnytimeMixin, BranchBoundMixin, PickUpMixin):
+    pass
+
+
+class CalcBySensitivity(CalcJiaGuoMeng, SensitivityMixin, BranchBoundMixin, PickUpMixin):
+    pass
+
+
+class CalcByUpgrade(CalcJiaGuoMeng, UpgradeMixin, BranchBoundMixin, PickUpMixin):
+    pass
+
+
+def parse_duration(ctx, param, value):
+    """ 200ms / 1.5s / 0.2 (秒) 转换为秒
+    """
+    if value is None:
+        return None
+    text = value.strip().lower()
+    try:
+        if text.endswith('ms'):
+            return float(text[:-2]) / 1000
+        return float(text[:-1] if text.endswith('s') else text)
+    except ValueError:
+        raise click.BadParameter('expected a duration like 200ms or 1.5s')
+
+
+# 每种求解模式的开关，及该模式下才生效的选项；其余选项显式给出即报错
+MODE_FLAGS = [
+    ('bomm', '-b'), ('branch', '-n'), ('milp', '-m'), ('time_budget', '--time-budget'), ('pareto', '-p'),
+]
+MODE_OPTIONS = {
+    'pick': {'offline', 'only', 'exact', 'refine', 'iterations', 'beam_width', 'beam_depth', 'no_cache', 'cache_file'},
+    'bomm': {'offline', 'exact', 'workers', 'top'},
+    'branch': {'offline', 'only', 'exact', 'no_cache', 'cache_file'},
+    'milp': {'offline', 'only', 'exact', 'no_cache', 'cache_file'},
+    'time_budget': {'offline', 'only', 'exact'},
+    'pareto': {'online_ratio'},
+}
+COMMON_OPTIONS = {'config', 'profile', 'profile_json', 'pstats'}
+
+
+def check_options(ctx):
+    """ 求解模式互斥，且只接受所选模式用得到的选项，避免参数被静默忽略
+    带子命令时只接受性能分析相关的选项，其余参数由子命令自己解析
+    """
+    opts = {
+        param.name: param.opts[-1] for param in ctx.command.params
+        if ctx.get_parameter_source(param.name) == click.core.ParameterSource.COMMANDLINE
+    }
+    modes = [name for name, _ in MODE_FLAGS if name in opts]
+    if len(modes) > 1:
+        raise click.UsageError('{} are mutually exclusive.'.format(', '.join(opts[name] for name in modes)))
+    if ctx.invoked_subcommand is not None:
+        target = 'the {} subcommand'.format(ctx.invoked_subcommand)
+        allowed = COMMON_OPTIONS - {'config'}
+    else:
+        mode = modes[0] if modes else 'pick'
+        target = '{} mode'.format(opts[mode] if modes else 'pick')
+        allowed = COMMON_OPTIONS | MODE_OPTIONS[mode] | {mode}
+    for name in sorted(set(opts) - allowed):
+        raise click.UsageError('{} does not apply to {}.'.format(opts[name], target))
+
+
+@click.group(invoke_without_command=True)
+@click.pass_context
 @click.option('-b', '--bomm', is_flag=True, help='Use Explosion Mod.')
+@click.option('-n', '--branch', is_flag=True, help='Use Branch and Bound Mod.')
+@click.option('-m', '--milp', is_flag=True, help='Use Mixed Integer Programming Mod.')
+@click.option('--time-budget', default=None, callback=parse_duration,
+              help='Return the best plan found within this time, e.g. 200ms.')
+@click.option('-p', '--pareto', is_flag=True, help='Explode online and offline together, print the Pareto front.')
+@click.option('--online-ratio', default=0.5, type=click.FloatRange(0, 1),
+              help='Share of time online, picks the best Pareto plan.')
 @click.option('-f', '--offline', is_flag=True, help='Offline Mod.')
 @click.option('-o', '--only', is_flag=True, help='Only One Building is very important!')
 @click.option('-c', '--config', default=CUSTOM_FILE_NAME, help='Set conf file path.')
-def main(bomm, offline, config, only):
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1), help='Explosion worker processes.')
+@click.option('-t', '--top', default=2, type=click.IntRange(min=1), help='Number of explosion plans to keep.')
+@click.option('-e', '--exact', is_flag=True, help='Re-score final plans with Decimal.')
+@click.option('-r', '--refine', type=click.Choice(['hill', 'anneal', 'block']), help='Local search after picking.')
+@click.option('-i', '--iterations', default=1000, type=click.IntRange(min=0), help='Local search iterations.')
+@click.option('--beam-width', default=1, type=click.IntRange(min=1), help='Merged plans kept per beam level.')
+@click.option('--beam-depth', default=3, type=click.IntRange(min=0), help='Number of beam levels.')
+@click.option('--no-cache', is_flag=True, help='Bypass the result cache.')
+@click.option('--cache-file', default=CACHE_FILE_NAME, help='Set result cache file path.')
+@click.option('--profile', is_flag=True, help='Report phase timings and hot path counters.')
+@click.option('--profile-json', default='profile.json', help='Set profile report path.')
+@click.option('--pstats', default=None, help='Dump cProfile stats to this path.')
+def main(ctx, bomm, branch, milp, time_budget, pareto, online_ratio, offline, config, only, workers, top, exact, refine,
+         iterations, beam_width, beam_depth, no_cache, cache_file, profile, profile_json, pstats):
+    check_options(ctx)
+    if pstats:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+    if profile:
+        PROFILER.enable()
+
+    def report_profile():
+        if profile:
+            PROFILER.print_report()
+            PROFILER.dump(profile_json)
+        if pstats:
+            profiler.disable()
+            profiler.dump_stats(pstats)
+
+    # 子命令返回后上下文关闭，再输出性能分析
+    ctx.call_on_close(report_profile)
+    if ctx.invoked_subcommand is not None:
+        return
+    if pareto:
+        CalcByExplosion(not offline, config, only).pareto_explosion(ratio=online_ratio)
+    elif time_budget is not None:
+        CalcByAnytime(not offline, config, only, exact=exact).run_anytime(time_budget)
+    else:
+        solve_main(bomm, branch, milp, offline, config, only, workers, top, exact, refine, iterations,
+                   beam_width, beam_depth, no_cache, cache_file)
+
+
+def solve_main(bomm, branch, milp, offline, config, only, workers, top, exact, refine, iterations,
+               beam_width, beam_depth, no_cache, cache_file):
     args = {
         'online_mod': not offline,
         'conf': config,
         'only': only,
+        'exact': exact,
     }
     if bomm:
         calculater = CalcByExplosion(**args)
-        calculater.explosion()
+        calculater.fast_explosion(top=top, workers=workers)
+        return
+    cache = None if no_cache else ResultCache(cache_file)
+    if branch:
+        calculater = CalcByBranch(**args)
+        calculater.run_branch(cache=cache)
+    elif milp:
+        calculater = CalcByMilp(**args)
+        calculater.run_milp(cache=cache)
     else:
         calculater = CalcByPick(**args)
-        calculater.run()
+        calculater.run(
+            refine=refine, iterations=iterations, beam_width=beam_width, beam_depth=beam_depth, cache=cache)
+    if cache is not None:
+        click.echo(cache.report(), err=True)
+        cache.close()
+
+
+@main.command()
+@click.argument('path')
+@click.option('-m', '--mode', default='pick', type=click.Choice(['pick', 'branch', 'milp']), help='Solving mode.')
+@click.option('-f', '--offline', is_flag=True, help='Offline Mod.')
+@click.option('-o', '--only', is_flag=True, help='Only One Building is very important!')
+@click.option('-w', '--workers', default=1, type=click.IntRange(min=1), help='Worker processes.')
+def batch(path, mode, offline, only, workers):
+    """ Solve a directory of yml configs or a JSON lines stream ('-' for stdin).
+    """
+    from batch import run_batch
+    solvers = {
+        'pick': (CalcByPick, 'solve'),
+        'branch': (CalcByBranch, 'solve_branch'),
+        'milp': (CalcByMilp, 'solve_milp'),
+    }
+    run_batch(path, solvers[mode], online=not offline, only=only, workers=workers)
+
+
+@main.command()
+@click.option('-s', '--socket', 'socket_path', default=None, help='Listen on a Unix socket instead of stdin.')
+@click.option('-t', '--threads', default=4, type=click.IntRange(min=1), help='Concurrent requests on stdin.')
+def serve(socket_path, threads):
+    """ Keep the solver warm and answer JSON lines requests.
+    """
+    from server import SolverService
+    service = SolverService({
+        'pick': (CalcByPick, 'solve', ['refine', 'iterations', 'beam_width', 'beam_depth']),
+        'branch': (CalcByBranch, 'solve_branch', []),
+        'milp': (CalcByMilp, 'solve_milp', ['time_limit']),
+        'anytime': (CalcByAnytime, 'solve_anytime', ['time_budget']),
+    })
+    if socket_path:
+        try:
+            service.serve_socket(socket_path)
+        except FileExistsError as e:
+            raise click.UsageError(str(e))
+    else:
+        service.serve_stdio(threads=threads)
+
+
+
+@main.command()
+@click.option('-c', '--config', default=CUSTOM_FILE_NAME, help='Set conf file path.')
+@click.option('-f', '--offline', is_flag=True, help='Offline Mod.')
+@click.option('-q', '--quests', is_flag=True, help='Also try raising each city quest building bonus.')
+@click.option('-n', '--limit', default=None, type=click.IntRange(min=1), help='Only print the best upgrades.')
+def sensitivity(config, offline, quests, limit):
+    """ Evaluate every single star upgrade and report the new optimal plan.
+    """
+    CalcBySensitivity(not offline, config, False).run_sensitivity(quests=quests, limit=limit)
+
+
+@main.command()
+@click.option('-c', '--config', default=CUSTOM_FILE_NAME, help='Set conf file path.')
+@click.option('-f', '--offline', is_flag=True, help='Offline Mod.')
+@click.option('-g', '--budget', required=True, type=click.FloatRange(min=0),
+              help='Upgrade budget, in units of the level 1 to 2 upgrade cost.')
+@click.option('-n', '--limit', default=None, type=click.IntRange(min=1), help='Only print the first upgrade runs.')
+def upgrade(config, offline, budget, limit):
+    """ Spend an upgrade budget on the optimal plan's buildings.
+    """
+    CalcByUpgrade(not offline, config, False).run_upgrade(budget, limit=limit)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import json
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+
+class Profiler(object):
+    """ 分阶段计时及热点计数
+    未启用时 phase 与 count 均为空操作，不影响正常运行
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.phases = []
+        self.counters = Counter()
+
+    def enable(self):
+        self.enabled = True
+        self.phases = []
+        self.counters = Counter()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def count(self, name, number=1):
+        if self.enabled:
+            self.counters[name] += number
+
+    def merge(self, report):
+        """ 并入其他进程 report() 的结果，用于汇总多进程批量求解
+        """
+        self.phases.extend((item['name'], item['seconds']) for item in report['phases'])
+        self.counters.update(report['counters'])
+
+    def totals(self):
+        """ 按阶段名称汇总 (名称, 次数, 总耗时)，按首次出现的顺序排列
+        """
+        totals = {}
+        for name, seconds in self.phases:
+            calls, total = totals.get(name, (0, 0.0))
+            totals[name] = (calls + 1, total + seconds)
+        return [(name, calls, total) for name, (calls, total) in totals.items()]
+
+    def report(self):
+        return {
+            'phases': [{'name': name, 'seconds': seconds} for name, seconds in self.phases],
+            'counters': dict(self.counters),
+        }
+
+    def print_report(self):
+        total = sum(seconds for _, seconds in self.phases) or 1
+        print('=' * 80)
+        print('性能分析')
+        for name, calls, seconds in self.totals():
+            print('{:<24}{:>10.2f}ms {:>6.1%}{}'.format(
+                name, seconds * 1000, seconds / total, ' x{}'.format(calls) if calls > 1 else ''))
+        for name, number in sorted(self.counters.items()):
+            print('{:<24}{:>12}'.format(name, number))
+        for name in sorted(self.counters):
+            if name.endswith('_hits'):
+                prefix = name[:-len('_hits')]
+                total = self.counters[name] + self.counters[prefix + '_misses']
+                print('{:<24}{:>12.1%}'.format(prefix + '_rate', self.counters[name] / total))
+
+    def dump(self, path):
+        with open(path, 'w') as report_file:
+            json.dump(self.report(), report_file, indent=2)
+
+
+PROFILER = Profiler()
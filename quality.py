@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import os
+import glob
+import time
+import json
+import multiprocessing
+
+import yaml
+import click
+
+from bench import synthetic_config
+from buildings import BuildingMatrix
+from consts import BUILDING_INFO
+from main import CalcByPick, CalcByBranch
+
+_worker_matrix = None
+
+
+def _init_worker():
+    global _worker_matrix
+    _worker_matrix = BuildingMatrix(BUILDING_INFO, numeric=float)
+
+
+def compare_case(job):
+    """ 同一份随机配置分别以挑选模式及分支定界求解，返回收益差距
+    """
+    seed, online, refine, beam_width, beam_depth = job
+    config = synthetic_config(BUILDING_INFO, seed=seed)
+    heuristic = CalcByPick(online, config, False, building_matrix=_worker_matrix).solve(
+        refine=refine, beam_width=beam_width, beam_depth=beam_depth)
+    exact = CalcByBranch(online, config, False, building_matrix=_worker_matrix).solve_branch()
+    heuristic_income = float(heuristic['total_income'])
+    exact_income = float(exact['total_income'])
+    return {
+        'seed': seed,
+        'heuristic': heuristic_income,
+        'exact': exact_income,
+        'gap': (exact_income - heuristic_income) / exact_income if exact_income else 0.0,
+    }
+
+
+def reproduce_command(path, offline, refine, beam_width, beam_depth):
+    """ 以相同求解参数复现该配置的挑选模式命令
+    """
+    args = ['python3', 'main.py', '-c', path, '--no-cache']
+    if offline:
+        args.append('-f')
+    if refine:
+        args.extend(['-r', refine])
+    args.extend(['--beam-width', str(beam_width), '--beam-depth', str(beam_depth)])
+    return ' '.join(args)
+
+
+def percentile(values, ratio):
+    return values[min(int(ratio * len(values)), len(values) - 1)]
+
+
+def summarize(results):
+    gaps = sorted(item['gap'] for item in results)
+    return {
+        'cases': len(gaps),
+        'optimal': sum(1 for gap in gaps if gap <= 1e-9) / len(gaps),
+        'mean': sum(gaps) / len(gaps),
+        'median': percentile(gaps, 0.5),
+        'p90': percentile(gaps, 0.9),
+        'p99': percentile(gaps, 0.99),
+        'max': gaps[-1],
+    }
+
+
+def histogram(results, edges=(0, 0.001, 0.005, 0.01, 0.02, 0.05, 0.1)):
+    """ 按收益差距分段计数，第一段为与最优解一致的配置
+    """
+    buckets = [0] * (len(edges) + 1)
+    for item in results:
+        if item['gap'] <= 1e-9:
+            buckets[0] += 1
+            continue
+        for index, edge in enumerate(edges[1:], 1):
+            if item['gap'] <= edge:
+                buckets[index] += 1
+                break
+        else:
+            buckets[-1] += 1
+    labels = ['最优'] + ['<={:.1%}'.format(edge) for edge in edges[1:]] + ['>{:.1%}'.format(edges[-1])]
+    return list(zip(labels, buckets))
+
+
+@click.command()
+@click.option('-n', '--count', default=1000, type=click.IntRange(min=1), help='Number of random configs.')
+@click.option('-s', '--seed', default=0, help='First random seed, configs use seed .. seed + count - 1.')
+@click.option('-w', '--workers', default=os.cpu_count() or 1, type=click.IntRange(min=1), help='Worker processes.')
+@click.option('-r', '--refine', type=click.Choice(['hill', 'anneal', 'block']), help='Local search for the pick solver.')
+@click.option('--beam-width', default=1, type=click.IntRange(min=1), help='Beam width for the pick solver.')
+@click.option('--beam-depth', default=3, type=click.IntRange(min=0), help='Beam depth for the pick solver.')
+@click.option('-f', '--offline', is_flag=True, help='Offline Mod.')
+@click.option('-k', '--worst', default=10, type=click.IntRange(min=0), help='Number of worst cases to dump.')
+@click.option('-o', '--output-dir', default='quality_worst', help='Directory for worst case configs.')
+def main(count, seed, workers, refine, beam_width, beam_depth, offline, worst, output_dir):
+    """ 随机生成配置，比较挑选模式与精确解的收益差距
+    """
+    jobs = [
+        (case_seed, not offline, refine, beam_width, beam_depth) for case_seed in range(seed, seed + count)
+    ]
+    start = time.perf_counter()
+    with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+        results = pool.map(compare_case, jobs, chunksize=16)
+    elapsed = time.perf_counter() - start
+    print('{} configs in {:.2f}s'.format(len(results), elapsed))
+    print(json.dumps(summarize(results), indent=2))
+    for label, number in histogram(results):
+        print('{:>8}: {}'.format(label, number))
+    worst_cases = sorted(results, key=lambda x: x['gap'], reverse=True)[:worst]
+    worst_cases = [item for item in worst_cases if item['gap'] > 1e-9]
+    # 清除上次运行留下的配置，目录内只保留本次的结果
+    for path in glob.glob(os.path.join(output_dir, 'seed_*.yml')):
+        os.unlink(path)
+    if worst_cases:
+        os.makedirs(output_dir, exist_ok=True)
+    for item in worst_cases:
+        path = os.path.join(output_dir, 'seed_{}.yml'.format(item['seed']))
+        command = reproduce_command(path, offline, refine, beam_width, beam_depth)
+        with open(path, 'w') as conf_file:
+            conf_file.write('# gap {:.3%}, pick {:.2f}, exact {:.2f}\n# {}\n'.format(
+                item['gap'], item['heuristic'], item['exact'], command))
+            yaml.safe_dump(synthetic_config(BUILDING_INFO, seed=item['seed']), conf_file, allow_unicode=True)
+        print('{}: gap {:.3%}, pick {:.2f}, exact {:.2f}'.format(
+            path, item['gap'], item['heuristic'], item['exact']))
+        print('    ' + command)
+
+
+if __name__ == '__main__':
+    main()
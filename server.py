@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# encoding: utf-8
+# author: 04
+
+import os
+import sys
+import json
+import stat
+import time
+import signal
+import threading
+import socketserver
+from concurrent.futures import ThreadPoolExecutor
+
+from buildings import BuildingMatrix
+from consts import BUILDING_INFO, STAR_NAMES
+
+# 求解参数的取值范围，与命令行一致: (类型, 下限, 下限是否可取)
+OPTION_RANGES = {
+    'iterations': (int, 0, True),
+    'beam_width': (int, 1, True),
+    'beam_depth': (int, 0, True),
+    'time_budget': ((int, float), 0, False),
+    'time_limit': ((int, float), 0, False),
+}
+REFINE_METHODS = [None, 'hill', 'anneal', 'block']
+
+
+class SolverService(object):
+    """ 常驻求解服务
+    每个线程持有一份已建立关联的建筑矩阵，请求之间只重置星级，互不共享可变状态。
+    请求为一行 JSON：
+        {"id": 1, "mode": "pick", "offline": false, "only": false, "refine": null,
+         "config": {...与 jiaguomeng.yml 结构相同...}}
+    也可用 "stars": {"木屋": 5, ...} 代替 config 中的 1星..5星 列表，"levels": {"木屋": 300, ...} 代替 等级。
+    """
+
+    def __init__(self, solvers):
+        self.solvers = solvers
+        self.local = threading.local()
+
+    def matrix(self):
+        matrix = getattr(self.local, 'matrix', None)
+        if matrix is None:
+            matrix = self.local.matrix = BuildingMatrix(BUILDING_INFO, numeric=float)
+        return matrix
+
+    def request_config(self, request):
+        config = dict(request.get('config') or {})
+        stars = request.get('stars')
+        if stars:
+            for star_name in STAR_NAMES:
+                config[star_name] = ' '.join(
+                    name for name, star in stars.items() if int(star) == int(star_name[:1]))
+        levels = request.get('levels')
+        if levels:
+            config['等级'] = levels
+        return config
+
+    def request_options(self, request, options):
+        """ 取出请求中的求解参数，并按命令行的取值范围检查
+        """
+        kwargs = {key: request[key] for key in options if key in request}
+        for key, value in kwargs.items():
+            if key == 'refine':
+                if value not in REFINE_METHODS:
+                    raise ValueError('Refine method %s is not allowed.' % value)
+                continue
+            value_type, low, inclusive = OPTION_RANGES[key]
+            if isinstance(value, bool) or not isinstance(value, value_type):
+                raise ValueError('Option %s should be a number.' % key)
+            if value < low or (value == low and not inclusive):
+                raise ValueError('Option %s should be %s %s.' % (key, '>=' if inclusive else '>', low))
+        return kwargs
+
+    def handle(self, line):
+        """ 每个请求总是返回一个结果，出错时以 error 字段说明，不会中断服务
+        """
+        start = time.perf_counter()
+        try:
+            request = json.loads(line)
+        except ValueError as error:
+            return {'error': 'ValueError: {}'.format(error)}
+        if not isinstance(request, dict):
+            return {'error': 'ValueError: request should be a JSON object.'}
+        response = {'id': request.get('id')}
+        try:
+            mode = request.get('mode', 'pick')
+            if mode not in self.solvers:
+                raise ValueError('Solving mode %s is not allowed.' % mode)
+            calc_class, method, options = self.solvers[mode]
+            calculater = calc_class(
+                not request.get('offline', False), self.request_config(request),
+                request.get('only', False), building_matrix=self.matrix())
+            kwargs = self.request_options(request, options)
+            response.update(calculater.plan_json(getattr(calculater, method)(**kwargs)))
+        except Exception as error:
+            response['error'] = '{}: {}'.format(type(error).__name__, error)
+        response['elapsed_ms'] = (time.perf_counter() - start) * 1000
+        return response
+
+    def serve_stdio(self, threads=4, stdin=sys.stdin, stdout=sys.stdout):
+        """ 从标准输入读取请求，按完成顺序逐行输出结果
+        """
+        lock = threading.Lock()
+
+        def respond(line):
+            text = json.dumps(self.handle(line), ensure_ascii=False)
+            with lock:
+                stdout.write(text + '\n')
+                stdout.flush()
+
+        with ThreadPoolExecutor(threads) as executor:
+            for line in stdin:
+                if line.strip():
+                    executor.submit(respond, line)
+
+    def serve_socket(self, path):
+        """ 监听本地 Unix socket，每个连接一个线程，连接内按行一问一答
+        """
+        service = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for line in self.rfile:
+                    if not line.strip():
+                        continue
+                    text = json.dumps(service.handle(line.decode(errors='replace')), ensure_ascii=False)
+                    self.wfile.write(text.encode() + b'\n')
+                    self.wfile.flush()
+
+        # 只清理上次遗留的 socket 文件，路径指向其他文件时报错，以免误删
+        if os.path.lexists(path):
+            if not stat.S_ISSOCK(os.lstat(path).st_mode):
+                raise FileExistsError('{} exists and is not a socket'.format(path))
+            os.unlink(path)
+        # SIGTERM 默认直接结束进程，不会执行 finally，改为抛出 SystemExit 以便删除 socket 文件
+        previous = signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(128 + signum))
+        try:
+            with socketserver.ThreadingUnixStreamServer(path, Handler) as server:
+                server.daemon_threads = True
+                try:
+                    server.serve_forever()
+                finally:
+                    os.unlink(path)
+        finally:
+            signal.signal(signal.SIGTERM, previous)